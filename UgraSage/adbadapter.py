@@ -0,0 +1,34 @@
+"""Модуль с асинхронным интерфейсом к состоянию диалога.
+
+Функции повторяют функции session, но выполняются в отдельном пуле
+потоков и не блокируют цикл событий. Драйвер базы с поддержкой asyncio
+может заменить их, сохранив сигнатуры."""
+
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import session
+
+# сколько запросов к базе может выполняться одновременно
+DB_WORKERS = int(os.environ.get('UGRASAGE_DB_WORKERS', 32))
+
+_executor = ThreadPoolExecutor(DB_WORKERS, thread_name_prefix='dbadapter')
+
+
+def _wrap(name):
+    # функция берется при вызове, чтобы ее можно было подменить в session
+    async def wrapper(*args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            _executor, getattr(session, name), *args)
+
+    wrapper.__name__ = name
+    return wrapper
+
+
+check_user = _wrap('check_user')
+get_clar = _wrap('get_clar')
+get_tmpdata = _wrap('get_tmpdata')
+set_tmpdata = _wrap('set_tmpdata')
+reset_tmpdata = _wrap('reset_tmpdata')
@@ -1,5 +1,7 @@
 """Модуль для формирования ответа пользователю."""
 
+import time
+import asyncio
 from copy import deepcopy
 
 from common import (
@@ -7,7 +9,9 @@ from common import (
     name2name_s,
     Entities
 )
-import dbadapter
+import session
+from ttlcache import TTLCache
+import adbadapter
 import entityextractor
 import intentextractor
 import entitychecker
@@ -22,38 +26,161 @@ from intenthandlers import (
 )
 
 
+# намерения, ответ на которые зависит только от проверенных сущностей и
+# времени, и длительность отрезка времени в секундах, в течение которого
+# ответ не меняется
+ANSWER_BUCKETS = {
+    'classList': 300,
+    'classPeer': 300,
+    'nextClass': 60
+}
+
+# намерения из ANSWER_BUCKETS, обработчики которых добавляют в ответ
+# данные конкретного пользователя, а не только его проверенных сущностей.
+# classList и classPeer получают usr_id, но группа, подгруппа и
+# преподаватель пользователя к их вызову уже есть в сущностях, поэтому
+# ответ на вопрос о группе общий для всех ее учащихся
+PER_USER_ANSWERS = set()
+
+# кэш готовых ответов, включается явно
+answers = None
+
+
+def enable_answer_cache(maxsize=4096):
+    global answers
+    answers = TTLCache(maxsize, max(ANSWER_BUCKETS.values()))
+
+
+def disable_answer_cache():
+    global answers
+    answers = None
+
+
+def invalidate_answers():
+    """Сбросить кэш ответов, например, после загрузки расписаний."""
+
+    if answers is not None:
+        answers.invalidate()
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(_) for _ in value)
+    return value
+
+
+def answer_key(intent, entities, ex_params, now):
+    # отрезки выровнены по эпохе, поэтому полночь по местному времени с
+    # целым числом часов смещения совпадает с их границей
+    usr_id = ex_params.get('usr_id') if intent in PER_USER_ANSWERS else None
+    return (intent, int(now // ANSWER_BUCKETS[intent]),
+            freeze(dict(entities)), usr_id)
+
+
+def handle_cached(intent, handler, entities, ans, ex_params):
+    """Вызвать обработчик или заполнить ans ответом на тот же вопрос о
+    тех же сущностях в том же отрезке времени. Ответы из PER_USER_ANSWERS
+    не разделяются между пользователями."""
+
+    cache = answers
+    if cache is None or intent not in ANSWER_BUCKETS:
+        handler(entities, ans, True, **ex_params)
+        return
+
+    now = time.time()
+    key = answer_key(intent, entities, ex_params, now)
+
+    res = cache.get(key)
+    if res is not None:
+        ans.update(deepcopy(res))
+        return
+
+    handler(entities, ans, True, **ex_params)
+
+    bucket = ANSWER_BUCKETS[intent]
+    cache.put(key, deepcopy(ans), ttl=bucket - now % bucket)
+
+
 def manage(essence):
     # фраза может быть пустой строкой
 
-    ans = {}
+    usr_id = essence['usr_id']
+
+    # состояние диалога кэшируется в процессе, см session
+    session.check_user(usr_id)
+    clar = session.get_clar(usr_id)
+
+    if 'welcome' in essence:
+        session.reset_tmpdata(usr_id)
+        return {'text': welcome(clar)}
+
+    tmpdata = session.get_tmpdata(usr_id)
+    ans = respond(essence, clar, tmpdata)
+    session.set_tmpdata(usr_id, tmpdata)
+
+    return ans
+
+
+async def manage_async(essence):
+    """Как manage, но запросы к базе не блокируют цикл событий, а разбор
+    фразы выполняется в пуле потоков."""
+
+    usr_id = essence['usr_id']
 
-    dbadapter.check_user(essence['usr_id'])
-    clar = dbadapter.get_clar(essence['usr_id'])
+    # состояние диалога кэшируется в процессе, см session, а после
+    # проверки пользователя независимые чтения выполняются одновременно
+    await adbadapter.check_user(usr_id)
 
     if 'welcome' in essence:
-        dbadapter.reset_tmpdata(essence['usr_id'])
-
-        if not clar:
-            welcome_msg = (
-                'Здравствуйте! Пожалуйста, назовите свою образовательную'
-                ' организацию, а также группу, если вы учащийся, или имя, если'
-                ' вы преподаватель.'
-            )
-        elif clar['isgp']:
-            welcome_msg = f'Привет! Твоя группа {clar["name"]}, а '
-
-            if not clar['subgp']:
-                welcome_msg += 'подгруппу ты не назвал.'
-            else:
-                welcome_msg += f'подгруппа {clar["subgp"]}.'
+        clar, _ = await asyncio.gather(
+            adbadapter.get_clar(usr_id),
+            adbadapter.reset_tmpdata(usr_id)
+        )
+        return {'text': welcome(clar)}
+
+    clar, tmpdata = await asyncio.gather(
+        adbadapter.get_clar(usr_id),
+        adbadapter.get_tmpdata(usr_id)
+    )
+
+    # извлечение сущностей занимает процессор, а не ожидает базу
+    loop = asyncio.get_running_loop()
+    ans = await loop.run_in_executor(None, respond, essence, clar, tmpdata)
+
+    await adbadapter.set_tmpdata(usr_id, tmpdata)
+
+    return ans
+
+
+def welcome(clar):
+    if not clar:
+        welcome_msg = (
+            'Здравствуйте! Пожалуйста, назовите свою образовательную'
+            ' организацию, а также группу, если вы учащийся, или имя, если'
+            ' вы преподаватель.'
+        )
+    elif clar['isgp']:
+        welcome_msg = f'Привет! Твоя группа {clar["name"]}, а '
+
+        if not clar['subgp']:
+            welcome_msg += 'подгруппу ты не назвал.'
         else:
-            usr_fulln = f'{clar["surn"]} {clar["firstn"]} {clar["patro"]}'
-            welcome_msg = f'Здравствуйте, {usr_fulln}!'
+            welcome_msg += f'подгруппа {clar["subgp"]}.'
+    else:
+        usr_fulln = f'{clar["surn"]} {clar["firstn"]} {clar["patro"]}'
+        welcome_msg = f'Здравствуйте, {usr_fulln}!'
+
+    welcome_msg += ' Можно спросить, что я умею.'
 
-        welcome_msg += ' Можно спросить, что я умею.'
+    return welcome_msg
 
-        ans['text'] = welcome_msg
-        return ans
+
+def respond(essence, clar, tmpdata):
+    """Ответ на фразу, временные данные изменяются на месте."""
+
+    ans = {}
 
     # команда, основные параметры и дополнительные
     # сущности будут проверяться с конца (см entitychecker)
@@ -106,8 +233,6 @@ def manage(essence):
     }
 
     # начало обработки фразы
-    tmpdata = dbadapter.get_tmpdata(essence['usr_id'])
-
     usr_ans = tmpdata['answer']
     cont_ents = tmpdata['context']['entities']
 
@@ -120,26 +245,42 @@ def manage(essence):
     else:
         # извлечь сущности непосредственно из фразы
         # во фразе значения сущностей унифицируются (1162б -> group)
-        entities, phrase = entityextractor.extract(essence['phrase'])
+        entities, phrase = entityextractor.extract(
+            essence['phrase'], clar['org'] if clar else None)
 
         # наложить сущности из фразы, которые определил клиент
         if 'entities' in essence:
             entities.update(essence['entities'])
 
-        intent = intentextractor.extract(phrase)
+        # намерение может определить клиент, иначе оно определяется по
+        # фразе с метками
+        if essence.get('intent') in handlers:
+            intent = essence['intent']
+        else:
+            intent = intentextractor.extract(phrase.text)
 
-        refs = entityextractor.extract_refs(phrase)
+        if any(_ for names in handlers[intent][1] for _ in names):
+            # токены фразы уже проанализированы экстракторами
+            refs = entityextractor.extract_refs(phrase)
 
-        # добавить сущности из контекста
-        entityextractor.cont_fill(phrase, entities, cont_ents, refs, intent)
-        cont_ents = deepcopy(entities)
+            # добавить сущности из контекста
+            entityextractor.cont_fill(
+                phrase, entities, cont_ents, refs, intent)
+            cont_ents = entityextractor.copy_entities(entities)
 
-        # добавить сущности из уточнения
-        entityextractor.clar_fill(phrase, entities, clar, refs)
+            # добавить сущности из уточнения
+            entityextractor.clar_fill(phrase, entities, clar, refs)
+        else:
+            # намерению сущности не нужны
+            cont_ents = entityextractor.copy_entities(entities)
 
     handler, ent_names, ex_params = handlers.get(intent)
     if entitychecker.check(ent_names, entities, usr_ans, ans):
-        handler(entities, ans, True, **ex_params)
+        handle_cached(intent, handler, entities, ans, ex_params)
+
+        # обработчик уточнения изменяет его в базе
+        if intent == 'userClar':
+            session.invalidate_clar(essence['usr_id'])
 
     # сохранить временные данные
     tmpdata['unchecked_ents'] = ent_names
@@ -152,7 +293,5 @@ def manage(essence):
     else:
         tmpdata['context']['entities'] = cont_ents
 
-    dbadapter.set_tmpdata(essence['usr_id'], tmpdata)
-
     assert ans['text']
     return ans
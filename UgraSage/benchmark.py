@@ -0,0 +1,327 @@
+"""Замер скорости извлечения сущностей.
+
+Через extract, extract_refs, cont_fill и clar_fill прогоняются примеры из
+выборки и синтетический корпус. Для каждого экстрактора и для конвейера в
+целом считаются фраз в секунду и перцентили задержки. Результаты
+сохраняются в JSON, чтобы сравнивать их между коммитами:
+
+    python benchmark.py --out before.json
+    python benchmark.py --out after.json
+    python benchmark.py --compare before.json after.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import subprocess
+
+from common import Entities
+import entityextractor
+
+SAMPLES = [
+    '../samples/classPeer.json'
+]
+
+TEMPLATES = [
+    'какие пары {day} у группы {group}',
+    'какие пары {day} в {school} классе',
+    'кто ведет {cls} у группы {group}, {subgp} подгруппа',
+    'где {day} будет {spec} по {cls}',
+    'где сейчас {name}?',
+    'а кто вел {cls} {day} у группы {group}?',
+    'кабинет {room} в корпусе {campus} свободен',
+    'что у него {day}',
+    'когда следующая пара у них',
+    'что ты умеешь'
+]
+
+SLOTS = {
+    'day': ['завтра', 'послезавтра', 'позавчера', 'в пятницу',
+            'на следующей неделе в среду', 'через 2 дня'],
+    'group': ['1162', '1491м', 'А1071', 'озбу-2н93н'],
+    'school': ['10а', '11г', '9б'],
+    'subgp': ['1', '2'],
+    'cls': ['химию нефти и газа', 'инженерную графику',
+            'основы программирования', 'математический анализ'],
+    'spec': ['лекция', 'практика', 'лаба'],
+    'name': ['Кутышкин Андрей', 'Иванова Мария Петровна', 'Петров'],
+    'room': ['312', '105', '41'],
+    'campus': ['1', '2', '5']
+}
+
+CLAR = {
+    'isgp': True,
+    'name': '1162б',
+    'subgp': None,
+    'org': 'Югорский государственный университет'
+}
+
+CONT_ENTS = {
+    'group': {'name': '1111'},
+    'class': {'name': 'химия'}
+}
+
+
+def load_samples(paths):
+    samples = []
+
+    for path in paths:
+        try:
+            with open(path, 'r') as f:
+                samples += [_['example'] for _ in json.load(f) if _['example']]
+        except OSError:
+            print(f'Пропущена выборка {path}', file=sys.stderr)
+
+    return samples
+
+
+def synthesize(count, seed):
+    rnd = random.Random(seed)
+
+    return [
+        rnd.choice(TEMPLATES).format(
+            **{k: rnd.choice(v) for k, v in SLOTS.items()})
+        for _ in range(count)
+    ]
+
+
+def percentile(values, q):
+    """Перцентиль методом ближайшего ранга."""
+
+    values = sorted(values)
+    i = max(0, min(len(values) - 1, round(q / 100 * len(values)) - 1))
+    return values[i]
+
+
+def summarize(times):
+    total = sum(times)
+
+    return {
+        'count': len(times),
+        'phrases_per_sec': len(times) / total if total else None,
+        'p50_ms': percentile(times, 50) * 1000,
+        'p95_ms': percentile(times, 95) * 1000,
+        'p99_ms': percentile(times, 99) * 1000
+    }
+
+
+def run_one(text, times):
+    clock = time.perf_counter
+    begin = clock()
+
+    # повторяет extract, но с замером каждого экстрактора
+    phrase = entityextractor.prepare(text)
+    entities = Entities()
+
+    for ent_name, extractor in entityextractor.extractors.items():
+        entity = {}
+        start = clock()
+        phrase = extractor(phrase, entity)
+        times[ent_name].append(clock() - start)
+        if entity:
+            entities[ent_name] = entity
+
+    start = clock()
+    refs = entityextractor.extract_refs(phrase)
+    times['refs'].append(clock() - start)
+
+    start = clock()
+    entityextractor.cont_fill(phrase, entities, CONT_ENTS, refs)
+    times['cont_fill'].append(clock() - start)
+
+    start = clock()
+    entityextractor.clar_fill(phrase, entities, CLAR, refs)
+    times['clar_fill'].append(clock() - start)
+
+    times['total'].append(clock() - begin)
+
+
+def run(phrases, repeat):
+    entityextractor.disable_cache()
+
+    # прогрев: сборка парсеров не должна попасть в замер
+    for text in phrases[:10]:
+        run_one(text, {k: [] for k in bench_steps()})
+
+    times = {k: [] for k in bench_steps()}
+    for _ in range(repeat):
+        for text in phrases:
+            run_one(text, times)
+
+    return {k: summarize(v) for k, v in times.items() if v}
+
+
+def bench_steps():
+    return [
+        *entityextractor.extractors,
+        'refs',
+        'cont_fill',
+        'clar_fill',
+        'total'
+    ]
+
+
+def check_combined(phrases):
+    """Сравнить сущности и ссылки при последовательном и общем разборе.
+    Вернуть фразы, для которых они различаются."""
+
+    entityextractor.disable_cache()
+    mode = entityextractor.combined
+    mismatches = []
+
+    try:
+        for text in phrases:
+            res = []
+            for entityextractor.combined in [False, True]:
+                entities, phrase = entityextractor.extract(text)
+                refs = entityextractor.extract_refs(phrase)
+                res.append((
+                    dict(entities),
+                    [(ref.main, ref.hint) for ref in refs]
+                ))
+
+            if res[0] != res[1]:
+                mismatches.append((text, *res))
+    finally:
+        entityextractor.combined = mode
+
+    return mismatches
+
+
+def check_grammar_cache():
+    """Дважды запустить процесс, который строит все парсеры. Вернуть
+    парсеры, которые второй процесс не загрузил из кэша на диске."""
+
+    code = (
+        'import json, entityextractor, grammarcache;'
+        'entityextractor._init_worker();'
+        'print(json.dumps(grammarcache.stats()))'
+    )
+
+    for _ in range(2):
+        out = subprocess.run(
+            [sys.executable, '-c', code],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout
+
+    stats = json.loads(out.splitlines()[-1])
+    return sorted(
+        name for name, sources in stats.items()
+        if set(sources) - {'disk', 'memory'}
+    )
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(before_path, after_path, threshold):
+    """Напечатать изменения p50 и p95. Вернуть True, если есть
+    замедление больше порога в процентах."""
+
+    with open(before_path) as f:
+        before = json.load(f)['results']
+    with open(after_path) as f:
+        after = json.load(f)['results']
+
+    slower = False
+
+    for corpus in after:
+        for step, res in after[corpus].items():
+            old = before.get(corpus, {}).get(step)
+            if not old:
+                continue
+
+            for metric in ['p50_ms', 'p95_ms']:
+                if not old[metric]:
+                    continue
+
+                change = (res[metric] / old[metric] - 1) * 100
+                mark = ''
+                if change > threshold:
+                    slower = True
+                    mark = ' !'
+
+                print(
+                    f'{corpus:10} {step:10} {metric:7}'
+                    f' {old[metric]:9.3f} -> {res[metric]:9.3f}'
+                    f' ({change:+.1f}%){mark}'
+                )
+
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--samples', nargs='*', default=SAMPLES)
+    parser.add_argument('--synthetic', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--out')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'))
+    parser.add_argument('--threshold', type=float, default=10.)
+    parser.add_argument('--check-combined', action='store_true')
+    parser.add_argument('--check-grammar-cache', action='store_true')
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, args.threshold) else 0)
+
+    if args.check_grammar_cache:
+        rebuilt = check_grammar_cache()
+        print(f'Не загружены из кэша: {", ".join(rebuilt) or "нет"}')
+        sys.exit(1 if rebuilt else 0)
+
+    corpora = {
+        'samples': load_samples(args.samples),
+        'synthetic': synthesize(args.synthetic, args.seed)
+    }
+
+    if args.check_combined:
+        mismatches = check_combined(
+            [text for phrases in corpora.values() for text in phrases])
+        for text, seq, comb in mismatches:
+            print(f'{text}\n  {seq}\n  {comb}')
+        print(f'Расхождений: {len(mismatches)}')
+        sys.exit(1 if mismatches else 0)
+
+    results = {
+        name: run(phrases, args.repeat)
+        for name, phrases in corpora.items() if phrases
+    }
+
+    report = {
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'sizes': {name: len(phrases) for name, phrases in corpora.items()},
+        'results': results
+    }
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    for corpus, steps in results.items():
+        for step, res in steps.items():
+            print(
+                f'{corpus:10} {step:10} {res["phrases_per_sec"]:10.1f}/s'
+                f' p50 {res["p50_ms"]:8.3f} p95 {res["p95_ms"]:8.3f}'
+                f' p99 {res["p99_ms"]:8.3f} мс'
+            )
+
+
+if __name__ == '__main__':
+    main()
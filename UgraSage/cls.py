@@ -10,18 +10,27 @@ Cls = fact(
     'Cls',
     ['spec', 'name']
 )
+# fact создает класс внутри yargy, где pickle его не найдет, а собранный
+# парсер хранится на диске (см grammarcache)
+Cls.__module__ = __name__
 
 samples = Path(__file__).resolve().parent.parent.parent / 'data' / 'classes'
+NAMES_PATH = samples / 'names.txt'
 
-base_names = []
-with open(samples / 'names.txt') as f:
-    for line in f:
-        name = line.rstrip()
-        base_names.append(name)
 
-case = case_relation()
+def load_names(path=NAMES_PATH):
+    base_names = []
+    with open(path) as f:
+        for line in f:
+            name = line.rstrip()
+            base_names.append(name)
+
+    return base_names
 
-BASE = morph_pipeline(base_names).match(case).named('BASE')
+
+base_names = load_names()
+
+case = case_relation()
 
 PREF = gram('ADJF').match(case).named('PREF')
 
@@ -60,17 +69,6 @@ DATV_SUFF, DATV_LONGSUFF = get_suff('datv')
 SUFF = or_(GENT_SUFF, DATV_SUFF).named('SUFF')
 LONGSUFF = or_(GENT_LONGSUFF, DATV_LONGSUFF).named('LONGSUFF')#.interpretation(Cls.name.custom(print))
 
-NAME = rule(
-    or_(LONGPREF, PREF).optional(),
-    BASE,
-    or_(LONGSUFF, SUFF).optional()
-).named('NAME')
-
-LONGNAME = rule(
-    NAME,
-    rule(SEP, NAME).repeatable()
-).named('LONGNAME')
-
 # правовые основы противодействия экстремизму и терроризму
 INTRO = rule(
     gram('ADJF').optional(),
@@ -82,15 +80,6 @@ INTRO = rule(
     eq(':').optional()
 ).named('INTRO')
 
-# основы кадровой политики и кадрового планирования
-FULLNAME = rule(
-    INTRO.optional(),
-    or_(LONGNAME, NAME)
-).interpretation(
-    Cls.name
-).named('FULLNAME')
-
-
 DOT = eq('.')
 
 LAB = morph_pipeline([
@@ -130,12 +119,40 @@ SPEC = rule(
     eq('по')
 ).named('SPEC')
 
-CLS = rule(
-    SPEC.optional(),
-    FULLNAME
-).interpretation(
-    Cls
-)
+
+# от словаря зависит только BASE, поэтому при изменении словаря
+# пересобираются только правила, которые его содержат
+def build(base_names):
+    BASE = morph_pipeline(base_names).match(case).named('BASE')
+
+    NAME = rule(
+        or_(LONGPREF, PREF).optional(),
+        BASE,
+        or_(LONGSUFF, SUFF).optional()
+    ).named('NAME')
+
+    LONGNAME = rule(
+        NAME,
+        rule(SEP, NAME).repeatable()
+    ).named('LONGNAME')
+
+    # основы кадровой политики и кадрового планирования
+    FULLNAME = rule(
+        INTRO.optional(),
+        or_(LONGNAME, NAME)
+    ).interpretation(
+        Cls.name
+    ).named('FULLNAME')
+
+    return rule(
+        SPEC.optional(),
+        FULLNAME
+    ).interpretation(
+        Cls
+    )
+
+
+CLS = build(base_names)
 
 #from graphviz import Source
 #Source('\n'.join(CLS.as_dot.source)).render(f'CLS.gv', view=True)
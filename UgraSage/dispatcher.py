@@ -0,0 +1,192 @@
+"""Модуль для распределения реплик пользователей по процессам.
+
+Пользователь закрепляется за процессом по согласованному хэшу usr_id,
+поэтому кэш состояния диалога в процессе (см session) остается
+корректным, а реплики одного пользователя обрабатываются по очереди. При
+добавлении процесса к нему переходит только часть пользователей, а
+прежние процессы сохраняют их изменения в базу и забывают их."""
+
+import os
+import bisect
+import hashlib
+from threading import Lock
+from concurrent.futures import ProcessPoolExecutor
+
+# число процессов по умолчанию
+WORKERS = int(os.environ.get('UGRASAGE_WORKERS', os.cpu_count() or 1))
+# число точек каждого процесса на кольце, от него зависит равномерность
+VNODES = 64
+
+
+def _hash(key):
+    return int.from_bytes(
+        hashlib.md5(str(key).encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Кольцо согласованного хэширования с виртуальными узлами."""
+
+    def __init__(self, nodes=(), vnodes=VNODES):
+        self.vnodes = vnodes
+        self.nodes = []
+        # отсортированные пары (хэш точки, узел)
+        self._points = []
+
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        if node in self.nodes:
+            return
+
+        self.nodes.append(node)
+        for i in range(self.vnodes):
+            bisect.insort(self._points, (_hash(f'{node}#{i}'), node))
+
+    def remove(self, node):
+        self.nodes.remove(node)
+        self._points = [_ for _ in self._points if _[1] != node]
+
+    def get(self, key):
+        if not self._points:
+            raise LookupError('Нет ни одного узла')
+
+        i = bisect.bisect(self._points, (_hash(key),))
+        return self._points[i % len(self._points)][1]
+
+
+# имя процесса, в котором выполняется обработчик
+_shard = None
+
+
+def _init_worker(name):
+    global _shard
+    _shard = name
+
+    # пользователи закреплены за процессом, поэтому кэш состояния
+    # диалога корректен
+    import session
+    session.enable()
+
+    import entityextractor
+    entityextractor._init_worker()
+
+
+def _manage(essence):
+    import ansmanager
+    return ansmanager.manage(essence)
+
+
+def _handoff(nodes, vnodes):
+    # сохранить и забыть пользователей, которые перешли к другим процессам
+    import session
+
+    if session.sessions is None:
+        return 0
+
+    ring = HashRing(nodes, vnodes)
+    moved = [_ for _ in session.sessions.users() if ring.get(_) != _shard]
+
+    session.sessions.flush()
+    for usr_id in moved:
+        session.sessions.invalidate(usr_id)
+
+    return len(moved)
+
+
+def _flush():
+    import session
+
+    if session.sessions is not None:
+        session.sessions.flush()
+
+
+class Dispatcher:
+    """Процессы с одним потоком, каждый из которых обслуживает своих
+    пользователей.
+
+    Процесс обрабатывает реплики в порядке поступления, поэтому реплики
+    одного пользователя не пересекаются, а разные процессы работают
+    параллельно."""
+
+    def __init__(self, workers=None, vnodes=VNODES):
+        self._lock = Lock()
+        self._shards = {}
+        self._ring = HashRing(vnodes=vnodes)
+        self._next = 0
+
+        for _ in range(workers or WORKERS):
+            self._start()
+
+    def _start(self):
+        name = f'w{self._next}'
+        self._next += 1
+
+        self._shards[name] = ProcessPoolExecutor(
+            1, initializer=_init_worker, initargs=(name,))
+        self._ring.add(name)
+
+        return name
+
+    def _rebalance(self):
+        # пока прежние процессы не сохранят состояние перешедших
+        # пользователей, новые реплики не распределяются
+        futures = [
+            shard.submit(_handoff, list(self._ring.nodes), self._ring.vnodes)
+            for shard in self._shards.values()
+        ]
+        return sum(_.result() for _ in futures)
+
+    def add_worker(self):
+        """Добавить процесс. Вернуть его имя."""
+
+        with self._lock:
+            name = self._start()
+            self._rebalance()
+
+        return name
+
+    def remove_worker(self, name):
+        with self._lock:
+            self._ring.remove(name)
+            shard = self._shards.pop(name)
+
+            # очередь процесса обрабатывается до конца
+            shard.submit(_flush).result()
+            shard.shutdown()
+
+            self._rebalance()
+
+    def shard(self, usr_id):
+        with self._lock:
+            return self._ring.get(usr_id)
+
+    def submit(self, essence):
+        """Поставить реплику в очередь процесса пользователя. Вернуть
+        concurrent.futures.Future с ответом."""
+
+        with self._lock:
+            shard = self._shards[self._ring.get(essence['usr_id'])]
+            return shard.submit(_manage, essence)
+
+    def manage(self, essence):
+        return self.submit(essence).result()
+
+    def close(self):
+        """Дождаться реплик в очередях и сохранить состояние диалогов."""
+
+        with self._lock:
+            # обработчики atexit в процессах пула не вызываются
+            for future in [_.submit(_flush) for _ in self._shards.values()]:
+                future.result()
+
+            for shard in self._shards.values():
+                shard.shutdown()
+
+            self._shards.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
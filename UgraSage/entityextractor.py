@@ -1,18 +1,28 @@
 """Модуль для извлечения именованных сущностей из фразы пользователя."""
 
+import os
 import re
+import time
 import functools
-from threading import Lock
+import itertools
+import importlib
+from collections import deque, Counter
+from concurrent.futures import ProcessPoolExecutor
+from threading import Thread, Lock
 
 import natasha
-from yargy import Parser
-
-# писать правила под обучающую выборку, не пытаться объять необъятное
-from grammars.ref import REF
-from grammars.cls import CLS
-from grammars.day import DAY
+from yargy import Parser, or_
+from yargy.interpretation import fact as make_fact
+from yargy.parser import prepare_trees, prepare_match
+from yargy.span import resolve_spans
 
 from common import Entities
+from parserpool import ParserPool
+from phrase import Phrase, TOKENIZER, skip_types
+from ttlcache import TTLCache
+import grammarcache
+import instrument
+import gazetteer
 
 stop_substrs = [
     'вроде',
@@ -27,35 +37,439 @@ stop_substrs = [
     'допустим'
 ]
 
+SPACE = r'\s+'
+
+
+def get_simple_variants(ENTITY, ENV):
+    return [
+        ENV +       SPACE + ENTITY,
+        ENTITY +    SPACE + ENV
+    ]
+
+
+# А1071
+# 2251
+# озбу-2н93н
+YSU = r'(\b([а-я]{1,4}\-|А)?[0-9]([0-9]|[а-я])[0-9]{2}[а-я]?\b)'
+
+# 11Г
+SCHOOL = r'(\b([1-9]|1[01])[а-я]\b)'
+
+# TODO сейчас не учитываются названия корпусов
+
+# сущности, которые извлекаются регулярными выражениями, и их варианты в
+# порядке приоритета
+patterns = {
+    'group': [f'(?P<group>{YSU}|{SCHOOL})'],
+    'subgp': get_simple_variants(
+        r'(?P<subgp>[1-9])',
+        r'(подгруп\w*)'),
+    'campus': get_simple_variants(
+        r'(?P<campus>[1-9])',
+        r'(корп\w*|дом\w*|здани\w*|постройк\w*|камп\w*)'),
+    'room': get_simple_variants(
+        r'(?P<room>\d+)',
+        r'(кабин\w*|комнат\w*)')
+}
+
+STOP = '|'.join(re.escape(s) for s in stop_substrs)
+STOP = f'\\s*\\b(?:{STOP})\\b'
+
+STOP_RE = re.compile(STOP, re.IGNORECASE)
+COMMAS_RE = re.compile(',{2,}')
+
+# варианты каждой сущности компилируются один раз при импорте
+REGEXPS = {
+    kind: [re.compile(variant, re.IGNORECASE) for variant in variants]
+    for kind, variants in patterns.items()
+}
+
+
+# писать правила под обучающую выборку, не пытаться объять необъятное
+grammars = {
+    'class': ('grammars.cls', 'CLS'),
+    'day': ('grammars.day', 'DAY'),
+    'ref': ('grammars.ref', 'REF')
+}
+
+# разбирать фразу одним парсером для CLS, DAY и REF вместо трех
+combined = os.environ.get('UGRASAGE_COMBINED') == '1'
+
+
+# находка общего парсера, fact -- факт сработавшей грамматики; без
+# интерпретации корневого правила yargy не может построить факт
+Combined = make_fact('Combined', ['fact'])
+Combined.__module__ = __name__
+
+
+def load_rule(name):
+    if name == 'combined':
+        return or_(*[load_rule(_) for _ in grammars]) \
+            .interpretation(Combined.fact).interpretation(Combined)
+
+    module, rule = grammars[name]
+    module = importlib.import_module(module)
+    # факты сохраняются на диск вместе с парсером
+    grammarcache.export_facts(module)
+    return getattr(module, rule)
+
+
+def create_parser(name):
+    """Собрать парсер грамматики или загрузить его из кэша. Модуль
+    грамматики импортируется только при первой сборке."""
+
+    def build():
+        return Parser(load_rule(name), tokenizer=TOKENIZER)
+
+    return grammarcache.load(name, build)
+
+
+def count_class_anchors(names, anchors=None, sign=1):
+    # любое совпадение CLS содержит BASE, а INTRO и SPEC необязательны и
+    # без BASE ничего не дают, поэтому достаточно первых слов названий
+    anchors = Counter() if anchors is None else anchors
+
+    for name in names:
+        tokens = list(TOKENIZER(name))
+        if tokens:
+            for lemma in token_lemmas(tokens[0]):
+                anchors[lemma] += sign
+
+    # леммы, которые больше не начинают ни одно название
+    for lemma in [k for k, v in anchors.items() if v <= 0]:
+        del anchors[lemma]
+
+    return anchors
+
+
+def build_class_anchors():
+    from grammars.cls import base_names
+
+    return count_class_anchors(base_names)
+
+
+def token_lemmas(token):
+    lemmas = {form.normalized for form in getattr(token, 'forms', None) or []}
+    lemmas.add(token.value.lower())
+    return {lemma.replace('ё', 'е') for lemma in lemmas}
+
+
+# леммы, с которых может начинаться название дисциплины, и число таких
+# названий
+class_anchors = None
+# сколько раз разбор CLS был пропущен и выполнен
+class_prefilter = Counter()
+
+
+def has_class_anchor(phrase):
+    global class_anchors
+
+    if class_anchors is None:
+        class_anchors = grammarcache.load('anchors', build_class_anchors)
+
+    return any(
+        not class_anchors.keys().isdisjoint(token_lemmas(token))
+        for token in phrase.tokenize()
+    )
+
+
+_reload_lock = Lock()
+
+
+def _reload_classes():
+    global class_anchors
+
+    from grammars import cls
+
+    # одновременно выполняется только одна пересборка, а запросы в это
+    # время обслуживаются старым парсером
+    if not _reload_lock.acquire(blocking=False):
+        return False
+
+    try:
+        names = cls.load_names()
+        if names == cls.base_names:
+            return False
+
+        # леммы пересчитываются только для изменившихся названий, а
+        # морфологический разбор остальных слов берется из кэша
+        # анализатора общего токенизатора
+        anchors = Counter(
+            class_anchors if class_anchors is not None
+            else grammarcache.load('anchors', build_class_anchors)
+        )
+        count_class_anchors(set(names) - set(cls.base_names), anchors)
+        count_class_anchors(set(cls.base_names) - set(names), anchors, -1)
+
+        rule = cls.build(names)
+        parser = Parser(rule, tokenizer=TOKENIZER)
+
+        cls.base_names, cls.CLS = names, rule
+
+        grammarcache.reset(grammarcache.DICT_DEPENDENT)
+        grammarcache.put('class', parser)
+        grammarcache.put('anchors', anchors)
+
+        new = {'class': [parser], 'combined': []}
+        if combined:
+            new['combined'].append(create_parser('combined'))
+
+        # подмена атомарна для запросов: выданные экземпляры дорабатывают,
+        # а следующие берутся уже из нового поколения
+        for name, instances in new.items():
+            parsers[name].replace(
+                functools.partial(create_parser, name), instances)
+        class_anchors = anchors
+
+        invalidate_cache()
+    finally:
+        _reload_lock.release()
+
+    return True
+
+
+def reload_classes(wait=False):
+    """Перечитать словарь дисциплин и пересобрать CLS в фоновом потоке."""
+
+    thread = Thread(target=_reload_classes, daemon=True)
+    thread.start()
+
+    if wait:
+        thread.join()
+
+    return thread
+
+
+def watch_classes(interval=10.):
+    """Перезагружать словарь дисциплин при изменении файла."""
+
+    from grammars import cls
+
+    def watch():
+        mtime = None
+        while True:
+            try:
+                current = os.stat(cls.NAMES_PATH).st_mtime_ns
+            except OSError:
+                current = None
+
+            if mtime is not None and current != mtime:
+                _reload_classes()
+            mtime = current
+
+            time.sleep(interval)
+
+    thread = Thread(target=watch, daemon=True)
+    thread.start()
+
+    return thread
+
+
+def create_natasha(Extractor):
+    extractor = Extractor()
+    tokenizer = extractor.parser.tokenizer
+
+    # natasha использует токенизатор yargy без некоторых типов токенов
+    # (переводов строк), поэтому ее токены фразы получаются из общих
+    # отбрасыванием этих типов
+    if type(tokenizer) is type(TOKENIZER):
+        skipped = TOKENIZER.types - tokenizer.types
+        rules = [_ for _ in TOKENIZER.rules if _.type not in skipped]
+
+        if rules == tokenizer.rules:
+            extractor.parser.tokenizer = \
+                skip_types(frozenset(skipped)) if skipped else TOKENIZER
+
+    return extractor
+
+
+# каждый поток получает собственный экземпляр парсера из пула, экземпляры
+# создаются при первом обращении
 parsers = {
-    'class': (Parser(CLS), Lock()),
-    'org': (natasha.OrganisationExtractor(), Lock()),
-    'empee': (natasha.NamesExtractor(), Lock()),
-    'day': (Parser(DAY), Lock()),
-    'ref': (Parser(REF), Lock())
+    'class': ParserPool(lambda: create_parser('class')),
+    'org': ParserPool(lambda: create_natasha(natasha.OrganisationExtractor)),
+    'empee': ParserPool(lambda: create_natasha(natasha.NamesExtractor)),
+    'day': ParserPool(lambda: create_parser('day')),
+    'ref': ParserPool(lambda: create_parser('ref')),
+    'combined': ParserPool(lambda: create_parser('combined'))
 }
 
+# кэш результатов по нормализованной фразе, включается явно
+cache = None
+
+
+def enable_cache(maxsize=4096, ttl=600.):
+    global cache
+    cache = TTLCache(maxsize, ttl)
+
+
+def disable_cache():
+    global cache
+    cache = None
+
+
+def invalidate_cache():
+    """Сбросить кэш, например, после изменения словаря дисциплин или
+    грамматик."""
+
+    if cache is not None:
+        cache.invalidate()
+
+
+def cache_stats():
+    return cache.stats() if cache is not None else None
+
+
+# результат извлечения зависит от известных сотрудников
+gazetteer.listeners.append(invalidate_cache)
+
 
 def drop_substrs(phrase, substrs=stop_substrs):
     """Функция для удаления неинформативных подстрок."""
 
-    for s in substrs:
-        phrase = re.sub(f'\\s*\\b{s}\\b', '', phrase, flags=re.IGNORECASE)
+    if substrs is stop_substrs:
+        phrase = STOP_RE.sub('', phrase)
+    else:
+        for s in substrs:
+            phrase = re.sub(
+                f'\\s*\\b{s}\\b', '', phrase, flags=re.IGNORECASE)
 
-    phrase = re.sub(',{2,}', '', phrase)
+    phrase = COMMAS_RE.sub('', phrase)
 
     return phrase
 
 
+def prepare(text):
+    """Фраза без неинформативных подстрок."""
+
+    phrase = Phrase(text)
+
+    stops = [res.span() for res in STOP_RE.finditer(text)]
+    if stops:
+        phrase.replace(stops, '')
+
+    # после удаления могли появиться новые последовательности запятых
+    commas = [res.span() for res in COMMAS_RE.finditer(phrase.text)]
+    if commas:
+        phrase.replace(commas, '')
+
+    return phrase
+
+
+def pool_stats():
+    """Статистика ожидания парсеров по каждому пулу."""
+
+    return {name: pool.stats() for name, pool in parsers.items()}
+
+
+def findall(name, phrase, resolve=True):
+    """Найти совпадения парсера name по готовым токенам фразы. Без
+    resolve возвращаются все деревья разбора в порядке findall yargy, в
+    том числе пересекающиеся."""
+
+    with parsers[name].checkout() as extractor:
+        # у экстракторов natasha парсер yargy хранится в атрибуте
+        parser = getattr(extractor, 'parser', extractor)
+
+        tokenizer = parser.tokenizer
+        parser.tokenizer = phrase.bind(tokenizer)
+        try:
+            # находки вычисляются лениво, поэтому их нужно получить до
+            # возврата экземпляра в пул
+            if not resolve:
+                return sorted(prepare_trees(parser.matches(phrase.text)))
+            if parser is extractor:
+                return list(parser.findall(phrase.text))
+
+            return list(extractor(phrase.text))
+        finally:
+            parser.tokenizer = tokenizer
+
+
+# сколько первых находок грамматики заменяет ее экстрактор: extract_class
+# -- одну, extract_day -- все, а ссылки не заменяются
+REPLACED = {'class': 1, 'day': None, 'ref': 0}
+
+
+def parse_combined(phrase):
+    """Разобрать фразу общим парсером и разложить находки по типам.
+
+    Пересечения разрешаются так же, как при последовательном разборе:
+    находки CLS, DAY и REF выбираются по очереди, как их выбрал бы
+    findall, среди тех, что не пересекаются с уже замененными участками.
+    Участки находок сдвигаются при замене сущностей, а пересекающиеся с
+    заменой пропадают, поэтому REF не берет участки, замененные place."""
+
+    from grammars.cls import Cls
+
+    candidates = {name: {} for name in grammars}
+
+    for tree in findall('combined', phrase, resolve=False):
+        match = prepare_match(tree)
+        if match is None:
+            continue
+
+        fact = match.fact.fact
+
+        if isinstance(fact, Cls):
+            kind = 'class'
+        elif hasattr(fact, 'main'):
+            kind = 'ref'
+        else:
+            kind = 'day'
+
+        # как в findall, из деревьев одного участка берется первое
+        candidates[kind].setdefault(tree.range, (fact, match.span))
+
+    found = {}
+    taken = []
+
+    # порядок grammars -- порядок последовательного разбора
+    for kind, matches in candidates.items():
+        spans = [
+            span for span in matches
+            if not any(span[0] < stop and start < span[1]
+                       for start, stop in taken)
+        ]
+        spans = list(resolve_spans(spans))
+
+        found[kind] = [matches[span] for span in spans]
+        # следующим грамматикам недоступны только замененные участки
+        taken.extend(spans[:REPLACED[kind]])
+
+    phrase.found.update(found)
+
+
+def get_matches(name, phrase):
+    """Факты и участки находок грамматики name."""
+
+    if combined and name not in phrase.found:
+        parse_combined(phrase)
+
+    if name in phrase.found:
+        return phrase.found[name]
+
+    return [(match.fact, match.span) for match in findall(name, phrase)]
+
+
+@instrument.traced('refs')
 def extract_refs(phrase):
+    if isinstance(phrase, str):
+        phrase = Phrase(phrase)
+
+    if cache is not None:
+        key = ('refs', phrase.text)
+        refs = cache.get(key)
+        if refs is not None:
+            return list(refs)
+
     refs = []
 
-    parser, lock = parsers['ref']
-    with lock:
-        matches = parser.findall(phrase)
+    for fact, _ in get_matches('ref', phrase):
+        refs.append(fact)
 
-    for match in matches:
-        refs.append(match.fact)
+    if cache is not None:
+        cache.put(key, list(refs))
 
     return refs
 
@@ -135,91 +549,146 @@ def cont_fill(phrase, entities, cont_ents, refs=[], intent=None):
             fill(['day'])
 
 
-def extract(phrase):
+def run_extractor(phrase, ent_name, extractor):
+    entity = {}
+
+    if instrument.hooks:
+        start = time.perf_counter()
+        replaced = phrase.replaced
+        phrase = extractor(phrase, entity)
+        instrument.emit(
+            ent_name,
+            time.perf_counter() - start,
+            phrase.replaced - replaced,
+            len(phrase.text)
+        )
+    else:
+        phrase = extractor(phrase, entity)
+
+    return phrase, entity
+
+
+def copy_entity(entity):
+    # значения полей -- строки, числа или словари частей имени, поэтому
+    # достаточно копировать на два уровня
+    return {
+        field: value.copy() if isinstance(value, (dict, list)) else value
+        for field, value in entity.items()
+    }
+
+
+def copy_entities(entities):
+    """Быстрая замена deepcopy для сущностей."""
+
+    return Entities({
+        ent_name: copy_entity(entity)
+        for ent_name, entity in dict.items(entities)
+    })
+
+
+@instrument.traced('extract', count=lambda res: len(res[0]))
+def extract(phrase, org=None):
     """Извлечь сущности, значения которых содержатся во вразе
     непосредственно. Если сущность может иметь несколько значений, то
-    она тут же унифицируется."""
+    она тут же унифицируется. Фраза возвращается вместе с токенами, чтобы
+    их не приходилось анализировать заново, а участок исходного текста
+    каждой сущности можно получить через phrase.origin_spans.
+
+    Имена сотрудников сначала ищутся среди известных сотрудников
+    организации org или организации из фразы."""
 
-    phrase = drop_substrs(phrase)
+    phrase = prepare(phrase)
+    phrase.org = org
     #print(phrase)
 
+    # вызывающий код изменяет сущности, поэтому кэш хранит и отдает копии
+    if cache is not None:
+        key = ('extract', phrase.text, org)
+        res = cache.get(key)
+        if res is not None:
+            return copy_entities(res[0]), res[1].copy()
+
     entities = Entities()
 
-    # вспомогательные функции извлекают сущность полностью
-    # если сущность неполная или не в начальной форме, то она
-    # исправляется в чекере
-    # поиск сущности осуществляется до первого нахождения для
-    # увеличения скорости
-    for ent_name, extractor in {
-            'org': extract_org,
-            'empee': extract_empee,
-            'group': extract_group,
-            'subgp': extract_subgp,
-            'class': extract_class,
-            'day': extract_day,
-            'place': extract_place}.items():
-        entity = {}
-        phrase = extractor(phrase, entity)
+    for ent_name, extractor in extractors.items():
+        phrase, entity = run_extractor(phrase, ent_name, extractor)
         if entity:
             entities[ent_name] = entity
 
+    if cache is not None:
+        cache.put(key, (copy_entities(entities), phrase.copy()))
+
     return entities, phrase
 
 
-def compile_variants(variants):
-    return map(functools.partial(re.compile, flags=re.IGNORECASE), variants)
+def _init_worker():
+    # построить парсеры один раз на процесс, а не на первой фразе
+    for name, pool in parsers.items():
+        if name not in grammars and name != 'combined' \
+                or (name == 'combined') == combined:
+            with pool.checkout():
+                pass
 
 
-def get_simple_variants(ENTITY, ENV):
-    SPACE = r'\s+'
+def _extract_chunk(chunk):
+    res = []
+    for phrase in chunk:
+        entities, phrase = extract(phrase)
+        res.append((entities, phrase.text))
 
-    return compile_variants([
-        ENV +       SPACE + ENTITY,
-        ENTITY +    SPACE + ENV
-    ])
+    return res
 
 
-def extract_place(phrase, entity):
-    # TODO сейчас не учитываются названия корпусов
+def extract_many(phrases, workers=None, chunksize=16):
+    """Извлечь сущности из множества фраз в нескольких процессах.
 
-    CAMPUS = r'(?P<campus>[1-9])'
-    ENV = r'(корп\w*|дом\w*|здани\w*|постройк\w*|камп\w*)'
-    phrase = regexp_extract(
-        phrase, get_simple_variants(CAMPUS, ENV), 'campus', entity, 'campus')
+    Фразы читаются из итератора порциями, поэтому корпус не загружается в
+    память целиком. Результаты возвращаются в порядке фраз в виде пар из
+    сущностей и текста фразы с метками."""
 
-    ROOM = r'(?P<room>\d+)'
-    ENV = r'(кабин\w*|комнат\w*)'
-    return regexp_extract(
-        phrase, get_simple_variants(ROOM, ENV), 'room', entity, 'room')
+    workers = workers or os.cpu_count() or 1
+    phrases = iter(phrases)
 
+    if workers == 1:
+        for phrase in phrases:
+            yield from _extract_chunk([phrase])
+        return
 
-def extract_group(phrase, entity):
-    # А1071
-    # 2251
-    # озбу-2н93н
-    YSU = r'(\b([а-я]{1,4}\-|А)?[0-9]([0-9]|[а-я])[0-9]{2}[а-я]?\b)'
+    with ProcessPoolExecutor(workers, initializer=_init_worker) as executor:
+        # ограничить число порций в работе, чтобы не читать корпус
+        # быстрее, чем он обрабатывается
+        pending = deque()
 
-    # 11Г
-    SCHOOL = r'(\b([1-9]|1[01])[а-я]\b)'
+        while True:
+            while len(pending) < workers * 2:
+                chunk = list(itertools.islice(phrases, chunksize))
+                if not chunk:
+                    break
+                pending.append(executor.submit(_extract_chunk, chunk))
 
-    GROUP = '|'.join([YSU, SCHOOL])
-    GROUP = f'(?P<group>{GROUP})'
+            if not pending:
+                return
 
-    return regexp_extract(
-        phrase, [re.compile(GROUP, re.IGNORECASE)], 'group', entity, 'name')
+            yield from pending.popleft().result()
 
 
-def extract_subgp(phrase, entity):
-    SUBGP = r'(?P<subgp>[1-9])'
-    ENV = r'(подгруп\w*)'
+def extract_place(phrase, entity):
+    phrase = regexp_extract(phrase, 'campus', entity, 'campus')
+    return regexp_extract(phrase, 'room', entity, 'room')
 
-    return regexp_extract(
-        phrase, get_simple_variants(SUBGP, ENV), 'subgp', entity, 'name')
+
+def extract_group(phrase, entity):
+    return regexp_extract(phrase, 'group', entity, 'name')
+
+
+def extract_subgp(phrase, entity):
+    return regexp_extract(phrase, 'subgp', entity, 'name')
 
 
-def regexp_extract(phrase, VARIANTS, holder, entity, field):
-    for exp in VARIANTS:
-        res = re.search(exp, phrase)
+def regexp_extract(phrase, holder, entity, field):
+    # варианты ищутся по тексту после замен предыдущих экстракторов
+    for exp in REGEXPS[holder]:
+        res = exp.search(phrase.text)
         if res:
             entity[field] = res.group(holder)
             return replace_entity(
@@ -230,14 +699,13 @@ def regexp_extract(phrase, VARIANTS, holder, entity, field):
 
 def extract_org(phrase, entity):
     # не приводится к начальной форме
-    extractor, lock = parsers['org']
-    with lock:
-        matches = extractor(phrase)
+    matches = findall('org', phrase)
 
     for match in matches:
         #print(' '.join([token.forms[0].normalized for token in match.tokens]))
         if any([_ in match.fact.name for _ in ['универ', 'школ', 'колледж']]):
             entity['name'] = match.fact.name
+            phrase.org = match.fact.name
             # если заменять на ОРГАНИЗАЦИЯ, то его захватит
             # extract_class
             return replace_entity(phrase, [match.span], 'org')
@@ -245,11 +713,36 @@ def extract_org(phrase, entity):
     return phrase
 
 
+def extract_known_empee(phrase, entity):
+    index = gazetteer.get(phrase.org)
+    if not index:
+        return None
+
+    tokens = phrase.tokenize()
+    name = {}
+    spans = []
+
+    for i, j, found in index.find(tokens):
+        # при совпадении нескольких сотрудников совпавшие части имени
+        # одинаковы, сотрудник уточняется в чекере
+        exid, fields = next(iter(found.items()))
+        name.update(index.name(exid, fields))
+        spans.append((tokens[i].span[0], tokens[j - 1].span[1]))
+
+    if not name:
+        return None
+
+    entity['name'] = name
+    return replace_entity(phrase, spans, 'empee')
+
+
 def extract_empee(phrase, entity):
+    # известные сотрудники находятся быстрее и без ложных срабатываний
+    if (known := extract_known_empee(phrase, entity)) is not None:
+        return known
+
     #extractor = natasha.SimpleNamesExtractor()
-    extractor, lock = parsers['empee']
-    with lock:
-        matches = extractor(phrase)
+    matches = findall('empee', phrase)
 
     name = {}
     spans = []
@@ -275,20 +768,26 @@ def extract_empee(phrase, entity):
 
 
 def extract_class(phrase, entity):
-    parser, lock = parsers['class']
-    with lock:
-        matches = parser.findall(phrase)
+    # в общем разборе остальные грамматики нужны в любом случае
+    if not combined:
+        if not has_class_anchor(phrase):
+            class_prefilter['skipped'] += 1
+            return phrase
 
-    for match in matches:
+        class_prefilter['parsed'] += 1
+
+    matches = get_matches('class', phrase)
+
+    for fact, span in matches:
         #from graphviz import Source
         #Source('\n'.join(match.tree.as_dot.source)).render(
         #    'clsmatch.gv', view=True)
 
-        for k, v in zip(['name', 'spec'], [match.fact.name, match.fact.spec]):
+        for k, v in zip(['name', 'spec'], [fact.name, fact.spec]):
             if v:
                 entity[k] = v
 
-        return replace_entity(phrase, [match.span], 'class')
+        return replace_entity(phrase, [span], 'class')
 
     return phrase
 
@@ -297,20 +796,17 @@ def extract_day(phrase, entity):
     """Смещение относительно текущего дня. Для абсолютных дат лучше
     подойдет расписание."""
 
-    parser, lock = parsers['day']
-    with lock:
-        matches = parser.findall(phrase)
+    matches = get_matches('day', phrase)
 
     spans = []
 
-    for match in matches:
-        f = match.fact
-        if match.fact.offset is not None:
+    for f, span in matches:
+        if f.offset is not None:
             entity['offset'] = f.offset * f.count * (-1 if f.backward else 1)
         else:
             entity['weekday'] = f.weekday * (-1 if f.backward else 1)
 
-        spans.append(match.span)
+        spans.append(span)
 
     if entity:
         return replace_entity(phrase, spans, 'day')
@@ -319,12 +815,25 @@ def extract_day(phrase, entity):
 
 
 def replace_entity(phrase, spans, holder):
-    d = 0
-    for span in spans:
-        phrase = phrase[:span[0]-d] + holder + phrase[span[1]-d:]
-        d += (span[1] - span[0]) - len(holder)
-
-    return phrase
+    # строка и токены фразы не перестраиваются целиком, а замена
+    # записывается вместе с участком исходного текста
+    return phrase.replace(spans, holder)
+
+
+# вспомогательные функции извлекают сущность полностью
+# если сущность неполная или не в начальной форме, то она
+# исправляется в чекере
+# поиск сущности осуществляется до первого нахождения для
+# увеличения скорости
+extractors = {
+    'org': extract_org,
+    'empee': extract_empee,
+    'group': extract_group,
+    'subgp': extract_subgp,
+    'class': extract_class,
+    'day': extract_day,
+    'place': extract_place
+}
 
 
 def test_file():
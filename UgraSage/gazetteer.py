@@ -0,0 +1,254 @@
+"""Модуль с указателем известных сотрудников организаций.
+
+Имена сотрудников ищутся по нормальным формам токенов фразы за один
+проход по префиксному дереву, поэтому NamesExtractor нужен только для
+фраз без известных имен. Одна фамилия без других частей имени
+ищется, только если написана с заглавной буквы. Указатель организации
+заполняется loader при первом обращении или явно через refresh, а при
+изменении записей о сотрудниках обновляется через update и remove.
+
+Сам модуль к базе не обращается: приложение при запуске назначает
+loader, например, запрос сотрудников организации из dbadapter. Пока
+loader не назначен и refresh не вызывался, get возвращает None и имена
+ищет только NamesExtractor."""
+
+import time
+import logging
+import functools
+import itertools
+from threading import Lock
+
+from phrase import TOKENIZER
+
+# порядки частей имени, в которых сотрудника называют во фразе
+ORDERS = [
+    ['surn', 'firstn', 'patro'],
+    ['firstn', 'patro', 'surn'],
+    ['surn', 'firstn'],
+    ['firstn', 'surn'],
+    ['firstn', 'patro'],
+    ['surn']
+]
+
+# ограничение на число вариантов нормальных форм одного ключа
+MAX_VARIANTS = 32
+
+# через сколько секунд повторять неудавшуюся загрузку сотрудников
+RETRY_AFTER = 60.
+
+END = None
+
+_logger = logging.getLogger(__name__)
+
+# функция организации, которая возвращает записи о ее сотрудниках
+loader = None
+# вызываются после изменения любого указателя
+listeners = []
+
+_lock = Lock()
+indexes = {}
+# ключ организации -> время неудавшейся загрузки
+_failures = {}
+
+
+def token_forms(token):
+    forms = {form.normalized for form in getattr(token, 'forms', None) or []}
+    forms.add(token.value.lower())
+    return forms
+
+
+def text_forms(text):
+    return [token_forms(token) for token in TOKENIZER(text)]
+
+
+@functools.lru_cache(maxsize=256)
+def normalize_org(name):
+    """Ключ организации, не зависящий от падежа и регистра."""
+
+    lemmas = []
+    for token in TOKENIZER(name):
+        forms = getattr(token, 'forms', None)
+        lemmas.append(forms[0].normalized if forms else token.value.lower())
+
+    return ' '.join(lemmas)
+
+
+class NameIndex:
+    """Префиксное дерево по нормальным формам частей имен сотрудников
+    одной организации. Записи имеют тот же вид, что и уточнение
+    преподавателя: firstn, surn, patro и exid."""
+
+    def __init__(self):
+        self._root = {}
+        self._lock = Lock()
+        # exid -> (запись, вставленные ключи)
+        self._records = {}
+
+    def __len__(self):
+        return len(self._records)
+
+    def _keys(self, record):
+        for order in ORDERS:
+            if not all(record.get(field) for field in order):
+                continue
+
+            parts = [text_forms(record[field]) for field in order]
+            variants = itertools.product(*[_ for part in parts for _ in part])
+
+            for key in itertools.islice(variants, MAX_VARIANTS):
+                yield key, tuple(order)
+
+    def add(self, record):
+        with self._lock:
+            self._remove(record['exid'])
+
+            keys = []
+            for key, fields in self._keys(record):
+                node = self._root
+                for form in key:
+                    node = node.setdefault(form, {})
+                node.setdefault(END, {})[record['exid']] = fields
+                keys.append(key)
+
+            self._records[record['exid']] = (dict(record), keys)
+
+    def remove(self, exid):
+        with self._lock:
+            self._remove(exid)
+
+    def _remove(self, exid):
+        if exid not in self._records:
+            return
+
+        _, keys = self._records.pop(exid)
+
+        for key in keys:
+            node = self._root
+            for form in key:
+                node = node.get(form)
+                if node is None:
+                    break
+            else:
+                node.get(END, {}).pop(exid, None)
+
+    def refresh(self, records):
+        """Обновить указатель, затронув только изменившиеся записи."""
+
+        records = {record['exid']: record for record in records}
+
+        for exid in set(self._records) - set(records):
+            self.remove(exid)
+
+        for exid, record in records.items():
+            old = self._records.get(exid)
+            if old is None or old[0] != record:
+                self.add(record)
+
+    def find(self, tokens):
+        """Самые длинные совпадения слева направо: список из номера
+        первого токена, номера после последнего токена и словаря из exid
+        в названия совпавших частей имени."""
+
+        forms = [token_forms(token) for token in tokens]
+        matches = []
+
+        i = 0
+        while i < len(tokens):
+            best = None
+            stack = [(self._root, i)]
+
+            while stack:
+                node, j = stack.pop()
+
+                # одна фамилия совпадает и с обычным словом ("белая
+                # доска"), поэтому без остальных частей имени она должна
+                # быть написана с заглавной буквы
+                if node.get(END) and (best is None or j > best[0]) \
+                        and (j - i > 1 or tokens[i].value[:1].isupper()):
+                    best = (j, dict(node[END]))
+
+                if j < len(tokens):
+                    for form in forms[j]:
+                        child = node.get(form)
+                        if child is not None:
+                            stack.append((child, j + 1))
+
+            if best:
+                matches.append((i, *best))
+                i = best[0]
+            else:
+                i += 1
+
+        return matches
+
+    def name(self, exid, fields):
+        record, _ = self._records.get(exid, ({}, None))
+        return {field: record[field] for field in fields if field in record}
+
+
+def _notify():
+    for listener in listeners:
+        listener()
+
+
+def get(org):
+    """Указатель организации или None, если сотрудники неизвестны."""
+
+    if not org:
+        return None
+
+    key = normalize_org(org)
+    index = indexes.get(key)
+    load = loader
+
+    if index is None and load is not None:
+        # пока база недоступна, загрузка не повторяется на каждой фразе
+        failed = _failures.get(key)
+        if failed is not None and time.monotonic() - failed < RETRY_AFTER:
+            return None
+
+        # запрос к базе выполняется без блокировки, чтобы не задерживать
+        # извлечение для других организаций, а из одновременно
+        # загруженных указателей остается первый
+        try:
+            records = load(org)
+        except Exception:
+            _failures[key] = time.monotonic()
+            _logger.warning(
+                'Не удалось загрузить сотрудников %s', org, exc_info=True)
+            return None
+
+        _failures.pop(key, None)
+
+        index = NameIndex()
+        index.refresh(records)
+
+        with _lock:
+            index = indexes.setdefault(key, index)
+
+    return index
+
+
+def refresh(org, records):
+    key = normalize_org(org)
+
+    with _lock:
+        index = indexes.setdefault(key, NameIndex())
+
+    index.refresh(records)
+    _notify()
+
+
+def update(org, record):
+    if (index := get(org)) is None:
+        refresh(org, [record])
+        return
+
+    index.add(record)
+    _notify()
+
+
+def remove(org, exid):
+    if (index := get(org)) is not None:
+        index.remove(exid)
+        _notify()
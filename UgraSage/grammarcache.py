@@ -0,0 +1,222 @@
+"""Модуль для хранения собранных парсеров грамматик на диске.
+
+Сборка парсера для CLS занимает много времени из-за морфологического
+анализа всех названий дисциплин, поэтому собранный парсер сохраняется и
+при следующем запуске загружается, если не изменились ни грамматики, ни
+словарь дисциплин."""
+
+import io
+import os
+import sys
+import pickle
+import hashlib
+import logging
+import importlib.util
+from pathlib import Path
+from threading import Lock
+from collections import Counter
+
+from yargy.interpretation import fact
+
+from phrase import TOKENIZER
+
+CACHE_DIR = Path(os.environ.get(
+    'UGRASAGE_GRAMMAR_CACHE',
+    Path(__file__).resolve().parent / '.grammarcache'
+))
+
+_logger = logging.getLogger(__name__)
+
+_lock = Lock()
+_locks = {}
+# имя парсера -> сериализованный парсер
+_blobs = {}
+# зависит ли ключ от словаря -> ключ
+_keys = {}
+# (имя парсера, откуда взят) -> сколько раз
+counts = Counter()
+
+# что зависит от словаря дисциплин
+DICT_DEPENDENT = {'class', 'combined', 'anchors'}
+
+
+class _Pickler(pickle.Pickler):
+    # общий токенизатор и морфологический анализатор не сохраняются, а
+    # подставляются при загрузке
+    def persistent_id(self, obj):
+        if obj is TOKENIZER:
+            return 'tokenizer'
+        if obj is getattr(TOKENIZER, 'morph', None):
+            return 'morph'
+        return None
+
+
+class _Unpickler(pickle.Unpickler):
+    def persistent_load(self, pid):
+        if pid == 'tokenizer':
+            return TOKENIZER
+        if pid == 'morph':
+            return TOKENIZER.morph
+        raise pickle.UnpicklingError(f'Неизвестная ссылка {pid}')
+
+
+def dumps(obj):
+    buf = io.BytesIO()
+    _Pickler(buf, pickle.HIGHEST_PROTOCOL).dump(obj)
+    return buf.getvalue()
+
+
+def loads(blob):
+    return _Unpickler(io.BytesIO(blob)).load()
+
+
+def export_facts(module):
+    """Сделать классы фактов модуля грамматики доступными pickle. fact
+    создает их внутри yargy, где pickle не находит их по имени."""
+
+    for name, value in vars(module).items():
+        if isinstance(value, type) and value.__module__ == fact.__module__:
+            value.__module__ = module.__name__
+            value.__qualname__ = name
+
+
+def stats():
+    """Откуда брались парсеры: memory, disk, built или unpicklable."""
+
+    res = {}
+    for (name, source), count in counts.items():
+        res.setdefault(name, {})[source] = count
+    return res
+
+
+def key(name):
+    """Хэш исходников грамматик, а для зависящих от словаря дисциплин
+    парсеров -- еще и словаря."""
+
+    with_names = name in DICT_DEPENDENT
+
+    if with_names not in _keys:
+        # модули грамматик не импортируются: cls при импорте читает словарь
+        # и собирает morph_pipeline, а этого и нужно избежать
+        spec = importlib.util.find_spec('grammars')
+        directory = Path(spec.submodule_search_locations[0]).resolve()
+
+        files = sorted(directory.glob('*.py'))
+        if with_names:
+            files.append(_names_path(directory))
+
+        h = hashlib.sha256()
+        for path in files:
+            h.update(path.name.encode())
+            h.update(path.read_bytes())
+
+        _keys[with_names] = h.hexdigest()[:16]
+
+    return _keys[with_names]
+
+
+def _names_path(directory):
+    # путь словаря дисциплин, как в grammars.cls, если модуль еще не
+    # импортирован
+    cls = sys.modules.get('grammars.cls')
+    if cls is not None:
+        return Path(cls.NAMES_PATH)
+    return directory.parent.parent / 'data' / 'classes' / 'names.txt'
+
+
+def reset(names=None):
+    """Забыть сохраненные в процессе парсеры names или все, например,
+    после изменения словаря дисциплин."""
+
+    with _lock:
+        if names is None:
+            _blobs.clear()
+            _keys.clear()
+        else:
+            for name in names:
+                _blobs.pop(name, None)
+                _keys.pop(name in DICT_DEPENDENT, None)
+
+
+def put(name, obj):
+    """Сохранить уже собранный парсер."""
+
+    try:
+        blob = dumps(obj)
+    except Exception:
+        _logger.warning('Не удалось сохранить парсер %s', name, exc_info=True)
+        return
+
+    _write(name, CACHE_DIR / f'{name}-{key(name)}.pickle', blob)
+
+    with _lock:
+        _blobs[name] = blob
+
+
+def _read(path):
+    try:
+        return path.read_bytes()
+    except OSError:
+        return None
+
+
+def _write(name, path, blob):
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+        tmp = path.with_suffix(f'.{os.getpid()}.tmp')
+        tmp.write_bytes(blob)
+        os.replace(tmp, path)
+
+        for old in CACHE_DIR.glob(f'{name}-*.pickle'):
+            if old != path:
+                old.unlink(missing_ok=True)
+    except OSError:
+        _logger.warning('Не удалось сохранить парсер %s', name, exc_info=True)
+
+
+def load(name, build):
+    """Получить новый экземпляр парсера name: из памяти процесса, с диска
+    или собрать его функцией build."""
+
+    with _lock:
+        lock = _locks.setdefault(name, Lock())
+
+    # разные парсеры собираются параллельно
+    with lock:
+        blob = _blobs.get(name)
+
+        if blob is None:
+            path = CACHE_DIR / f'{name}-{key(name)}.pickle'
+
+            if (blob := _read(path)) is not None:
+                try:
+                    parser = loads(blob)
+                except Exception:
+                    _logger.warning('Кэш парсера %s поврежден', name)
+                    blob = None
+                else:
+                    _blobs[name] = blob
+                    counts[name, 'disk'] += 1
+                    return parser
+
+            parser = build()
+            try:
+                blob = dumps(parser)
+            except Exception:
+                # например, интерпретация с lambda или факт, не
+                # переданный в export_facts, -- парсер работает и без кэша
+                _logger.warning(
+                    'Не удалось сохранить парсер %s', name, exc_info=True)
+                counts[name, 'unpicklable'] += 1
+                return parser
+
+            _write(name, path, blob)
+
+            _blobs[name] = blob
+            counts[name, 'built'] += 1
+            return parser
+
+        counts[name, 'memory'] += 1
+
+    return loads(blob)
@@ -0,0 +1,151 @@
+"""Модуль для замера шагов извлечения сущностей.
+
+Хуки вызываются после каждого шага с его названием, временем в секундах,
+числом находок и длиной фразы. Пока хуков и профилировщика нет, шаги не
+замеряются."""
+
+import os
+import time
+import heapq
+import random
+import cProfile
+import functools
+import itertools
+from threading import Lock
+from collections import defaultdict
+
+hooks = []
+profiler = None
+
+
+def add_hook(hook):
+    hooks.append(hook)
+
+
+def remove_hook(hook):
+    hooks.remove(hook)
+
+
+def emit(step, seconds, matches, length):
+    for hook in hooks:
+        hook(step, seconds, matches, length)
+
+
+class Metrics:
+    """Хук, который накапливает статистику по шагам."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._steps = defaultdict(lambda: {
+            'calls': 0,
+            'time': 0.,
+            'max_time': 0.,
+            'matches': 0,
+            'chars': 0
+        })
+
+    def __call__(self, step, seconds, matches, length):
+        with self._lock:
+            stat = self._steps[step]
+            stat['calls'] += 1
+            stat['time'] += seconds
+            stat['max_time'] = max(stat['max_time'], seconds)
+            stat['matches'] += matches
+            stat['chars'] += length
+
+    def snapshot(self):
+        with self._lock:
+            return {step: dict(stat) for step, stat in self._steps.items()}
+
+    def reset(self):
+        with self._lock:
+            self._steps.clear()
+
+
+class SlowestProfiles:
+    """Профилирует долю вызовов и хранит профили n самых медленных."""
+
+    def __init__(self, n=10, rate=.01):
+        self.n = n
+        self.rate = rate
+
+        self._lock = Lock()
+        self._seq = itertools.count()
+        # куча (время, номер, фраза, профиль)
+        self._slowest = []
+
+    def sample(self):
+        return random.random() < self.rate
+
+    def run(self, func, text, *args):
+        prof = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            return prof.runcall(func, *args)
+        finally:
+            item = (time.perf_counter() - start, next(self._seq), text, prof)
+            with self._lock:
+                if len(self._slowest) < self.n:
+                    heapq.heappush(self._slowest, item)
+                else:
+                    heapq.heappushpop(self._slowest, item)
+
+    def slowest(self):
+        with self._lock:
+            return [item[:3] for item in sorted(self._slowest, reverse=True)]
+
+    def dump(self, out_dir):
+        """Сохранить профили в out_dir для просмотра через pstats или
+        snakeviz, а фразы -- в index.txt."""
+
+        os.makedirs(out_dir, exist_ok=True)
+
+        with self._lock:
+            items = sorted(self._slowest, reverse=True)
+
+        with open(os.path.join(out_dir, 'index.txt'), 'w') as index:
+            for i, (seconds, _, text, prof) in enumerate(items):
+                prof.dump_stats(os.path.join(out_dir, f'{i:03}.prof'))
+                index.write(f'{i:03}\t{seconds * 1000:.3f}\t{text}\n')
+
+
+def enable_profiling(n=10, rate=.01):
+    global profiler
+    profiler = SlowestProfiles(n, rate)
+    return profiler
+
+
+def disable_profiling():
+    global profiler
+    profiler = None
+
+
+def traced(step, count=len):
+    """Замерить функцию, первый аргумент которой -- фраза, а число находок
+    считается по результату функцией count."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(phrase, *args, **kwargs):
+            prof = profiler
+            if not hooks and prof is None:
+                return func(phrase, *args, **kwargs)
+
+            start = time.perf_counter()
+            if prof is not None and prof.sample():
+                res = prof.run(
+                    functools.partial(func, phrase, *args, **kwargs),
+                    str(phrase)
+                )
+            else:
+                res = func(phrase, *args, **kwargs)
+
+            if hooks:
+                emit(step, time.perf_counter() - start, count(res),
+                     len(str(phrase)))
+
+            return res
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,313 @@
+"""Нагрузочный тест ansmanager.manage без базы данных.
+
+Одновременно N пользователей ведут диалоги: приветствие, вопросы,
+ответы на уточняющие вопросы и ссылки на контекст вроде «у него».
+Вместо dbadapter подставляется MemoryDB с заданной задержкой каждого
+запроса, поэтому тест работает без сети. В отчете -- ответов в секунду,
+перцентили задержки и ожидание парсеров в пулах:
+
+    python loadtest.py --users 50 --turns 20 --latency 5
+    python loadtest.py --users 200 --mode async --out load.json
+"""
+
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import threading
+from copy import deepcopy
+from collections import defaultdict
+
+# вопросы, в которых сущности берутся из слотов benchmark, и продолжения
+# со ссылками на сущности из предыдущего вопроса
+FLOWS = [
+    ['какие пары {day}', 'а {day}?', 'когда следующая пара у них'],
+    ['где сейчас {name}?', 'что у него {day}', 'а где он будет {day}?'],
+    ['кто ведет {cls} у группы {group}', 'где будет {spec} по {cls}',
+     'а у него что {day}?'],
+    ['какие пары {day} у группы {group}, {subgp} подгруппа',
+     'когда следующая пара'],
+    ['что ты умеешь'],
+    ['я из группы {group}', 'какие пары {day}']
+]
+
+# ответы на уточняющие вопросы по предмету вопроса
+ANSWERS = {
+    'group': ['1162', '1491м', 'А1071'],
+    'subgp': ['1', '2'],
+    'empee': ['Кутышкин Андрей', 'Иванова Мария Петровна'],
+    'day': ['завтра', 'в пятницу'],
+    'class': ['химия', 'основы программирования'],
+    'org': ['Югорский государственный университет']
+}
+
+
+def empty_tmpdata():
+    return {
+        'answer': {'subject': None, 'text': None},
+        'context': {'intent': None, 'entities': {}},
+        'unchecked_ents': []
+    }
+
+
+class MemoryDB:
+    """Замена dbadapter, которая хранит данные в памяти и отвечает с
+    задержкой latency ± jitter секунд.
+
+    Запросы обработчиков намерений, которых нет среди методов, получают
+    default, чтобы тест не зависел от расписаний в базе."""
+
+    def __init__(self, latency=0., jitter=0., default=(), seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.default = default
+
+        self._rnd = random.Random(seed)
+        self._lock = threading.Lock()
+
+        self.users = set()
+        self.clars = {}
+        self.tmpdata = {}
+        self.calls = defaultdict(int)
+
+    def _wait(self, name):
+        with self._lock:
+            self.calls[name] += 1
+            delay = self.latency + self._rnd.uniform(-self.jitter, self.jitter)
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def check_user(self, usr_id):
+        self._wait('check_user')
+        with self._lock:
+            if usr_id not in self.users:
+                self.users.add(usr_id)
+                self.tmpdata[usr_id] = empty_tmpdata()
+
+    def get_clar(self, usr_id):
+        self._wait('get_clar')
+        with self._lock:
+            return deepcopy(self.clars.get(usr_id))
+
+    def set_clar(self, usr_id, clar):
+        self._wait('set_clar')
+        with self._lock:
+            self.clars[usr_id] = deepcopy(clar)
+
+    def get_tmpdata(self, usr_id):
+        self._wait('get_tmpdata')
+        with self._lock:
+            return deepcopy(self.tmpdata[usr_id])
+
+    def set_tmpdata(self, usr_id, tmpdata):
+        self._wait('set_tmpdata')
+        with self._lock:
+            self.tmpdata[usr_id] = deepcopy(tmpdata)
+
+    def reset_tmpdata(self, usr_id):
+        self._wait('reset_tmpdata')
+        with self._lock:
+            self.tmpdata[usr_id] = empty_tmpdata()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def query(*args, **kwargs):
+            self._wait(name)
+            return deepcopy(self.default)
+
+        return query
+
+
+def install(db):
+    """Подставить db вместо dbadapter до импорта ansmanager."""
+
+    sys.modules['dbadapter'] = db
+
+
+class User:
+    """Диалог одного пользователя: очередь фраз сценария и ответы на
+    уточняющие вопросы."""
+
+    def __init__(self, usr_id, turns, rnd, slots):
+        self.usr_id = usr_id
+        self.turns = turns
+        self.rnd = rnd
+        self.slots = slots
+        self._queue = []
+
+    def fill(self, template):
+        return template.format(
+            **{k: self.rnd.choice(v) for k, v in self.slots.items()})
+
+    def essences(self, pending):
+        """Сообщения пользователя, pending() -- предмет уточняющего
+        вопроса после предыдущего ответа или None."""
+
+        yield {'usr_id': self.usr_id, 'welcome': True}
+
+        for _ in range(self.turns):
+            subject = pending()
+
+            if subject:
+                # ответ на уточняющий вопрос вместо следующей фразы
+                phrase = self.rnd.choice(
+                    ANSWERS.get(subject, sum(ANSWERS.values(), [])))
+            else:
+                if not self._queue:
+                    self._queue = list(self.rnd.choice(FLOWS))
+                phrase = self.fill(self._queue.pop(0))
+
+            yield {'usr_id': self.usr_id, 'phrase': phrase}
+
+
+def run_threads(ansmanager, users, think, pending):
+    times = []
+    errors = []
+    lock = threading.Lock()
+
+    def run(user):
+        for essence in user.essences(lambda: pending(user.usr_id)):
+            start = time.perf_counter()
+            try:
+                ansmanager.manage(essence)
+            except Exception as e:
+                with lock:
+                    errors.append(repr(e))
+            else:
+                with lock:
+                    times.append(time.perf_counter() - start)
+
+            if think:
+                time.sleep(user.rnd.uniform(0, think))
+
+    threads = [threading.Thread(target=run, args=(_,)) for _ in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return times, errors
+
+
+def run_async(ansmanager, users, think, pending):
+    times = []
+    errors = []
+
+    async def run(user):
+        for essence in user.essences(lambda: pending(user.usr_id)):
+            start = time.perf_counter()
+            try:
+                await ansmanager.manage_async(essence)
+            except Exception as e:
+                errors.append(repr(e))
+            else:
+                times.append(time.perf_counter() - start)
+
+            if think:
+                await asyncio.sleep(user.rnd.uniform(0, think))
+
+    async def main():
+        await asyncio.gather(*[run(_) for _ in users])
+
+    asyncio.run(main())
+    return times, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--turns', type=int, default=10)
+    parser.add_argument('--mode', choices=['thread', 'async'],
+                        default='thread')
+    # в миллисекундах
+    parser.add_argument('--latency', type=float, default=2.)
+    parser.add_argument('--jitter', type=float, default=1.)
+    parser.add_argument('--think', type=float, default=0.)
+    # доля пользователей, которые уже назвали группу
+    parser.add_argument('--clarified', type=float, default=.7)
+    parser.add_argument('--no-session-cache', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out')
+    args = parser.parse_args()
+
+    db = MemoryDB(args.latency / 1000, args.jitter / 1000, seed=args.seed)
+    install(db)
+
+    import session
+    import benchmark
+    import ansmanager
+    import entityextractor
+
+    # все пользователи обслуживаются одним процессом
+    if not args.no_session_cache:
+        session.enable()
+
+    rnd = random.Random(args.seed)
+    users = []
+    for usr_id in range(args.users):
+        if rnd.random() < args.clarified:
+            db.clars[usr_id] = dict(benchmark.CLAR)
+        users.append(User(usr_id, args.turns,
+                          random.Random(rnd.random()), benchmark.SLOTS))
+
+    def pending(usr_id):
+        # при отложенной записи последние данные есть только в кэше
+        tmpdata = None
+        if session.sessions is not None:
+            tmpdata = session.sessions.peek_tmpdata(usr_id)
+        if tmpdata is None:
+            with db._lock:
+                tmpdata = db.tmpdata.get(usr_id, empty_tmpdata())
+
+        return tmpdata['answer']['subject']
+
+    run = run_async if args.mode == 'async' else run_threads
+
+    begin = time.perf_counter()
+    times, errors = run(ansmanager, users, args.think, pending)
+    elapsed = time.perf_counter() - begin
+
+    if session.sessions is not None:
+        session.sessions.flush()
+
+    report = {
+        'users': args.users,
+        'turns': args.turns,
+        'mode': args.mode,
+        'latency_ms': args.latency,
+        'elapsed': elapsed,
+        'answers_per_sec': len(times) / elapsed if elapsed else None,
+        'latency': benchmark.summarize(times) if times else None,
+        'errors': len(errors),
+        'db_calls': dict(db.calls),
+        'pools': entityextractor.pool_stats(),
+        'session': session.sessions.stats() if session.sessions else None
+    }
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print(f'{len(times)} ответов за {elapsed:.2f} с,'
+          f' {report["answers_per_sec"]:.1f}/с, ошибок {len(errors)}')
+    if times:
+        res = report['latency']
+        print(f'p50 {res["p50_ms"]:.3f} p95 {res["p95_ms"]:.3f}'
+              f' p99 {res["p99_ms"]:.3f} мс')
+    for name, stat in report['pools'].items():
+        if stat['checkouts']:
+            print(f'{name:10} выдач {stat["checkouts"]:7}'
+                  f' ожиданий {stat["waits"]:6}'
+                  f' всего {stat["wait_time"] * 1000:9.3f} мс'
+                  f' макс {stat["max_wait"] * 1000:8.3f} мс')
+    for error in sorted(set(errors))[:10]:
+        print(error, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
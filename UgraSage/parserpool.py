@@ -0,0 +1,111 @@
+"""Модуль с пулом парсеров для извлечения сущностей в нескольких потоках."""
+
+import os
+import time
+from collections import deque
+from threading import Condition
+from contextlib import contextmanager
+
+# размер пула по умолчанию, задается в окружении сервера приложений
+POOL_SIZE = int(os.environ.get('UGRASAGE_POOL_SIZE', os.cpu_count() or 1))
+
+
+class ParserPool:
+    """Ограниченный пул однотипных парсеров.
+
+    Парсеры yargy и экстракторы natasha не потокобезопасны, поэтому
+    экземпляр выдается только одному потоку на время checkout.
+    Экземпляры создаются фабрикой по требованию, но не больше size."""
+
+    def __init__(self, factory, size=None):
+        self.factory = factory
+        self.size = size or POOL_SIZE
+
+        # пары (поколение, экземпляр) текущего поколения, экземпляры
+        # старых поколений при возврате отбрасываются
+        self._idle = deque()
+        # потоки ждут, пока не вернут экземпляр или не освободится место
+        # для создания нового
+        self._cond = Condition()
+        self._created = 0
+        self._generation = 0
+
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.
+        self.max_wait = 0.
+
+    def _acquire(self):
+        start = None
+
+        with self._cond:
+            while not self._idle and self._created >= self.size:
+                if start is None:
+                    start = time.perf_counter()
+                self._cond.wait()
+
+            if start is not None:
+                waited = time.perf_counter() - start
+                self.waits += 1
+                self.wait_time += waited
+                self.max_wait = max(self.max_wait, waited)
+
+            if self._idle:
+                return self._idle.pop()
+
+            self._created += 1
+            generation = self._generation
+            factory = self.factory
+
+        # экземпляр создается без блокировки, чтобы не задерживать
+        # возврат других экземпляров
+        try:
+            return generation, factory()
+        except BaseException:
+            # освободившееся место может занять ожидающий поток
+            with self._cond:
+                if generation == self._generation:
+                    self._created -= 1
+                self._cond.notify()
+            raise
+
+    @contextmanager
+    def checkout(self):
+        item = self._acquire()
+        with self._cond:
+            self.checkouts += 1
+
+        try:
+            yield item[1]
+        finally:
+            with self._cond:
+                if item[0] == self._generation:
+                    self._idle.append(item)
+                self._cond.notify()
+
+    def replace(self, factory, instances=()):
+        """Подменить фабрику без ожидания выданных экземпляров. Экземпляры
+        старого поколения после возврата в пул больше не выдаются."""
+
+        with self._cond:
+            self.factory = factory
+            self._generation += 1
+            self._created = len(instances)
+            self._idle = deque(
+                (self._generation, instance) for instance in instances)
+
+            # место старых экземпляров могут занять новые
+            self._cond.notify_all()
+
+    def stats(self):
+        """Сколько раз и как долго потоки ждали свободный экземпляр."""
+
+        with self._cond:
+            return {
+                'size': self.size,
+                'created': self._created,
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+                'max_wait': self.max_wait
+            }
@@ -0,0 +1,293 @@
+"""Модуль с фразой, которая токенизируется один раз для всех экстракторов."""
+
+import functools
+from copy import copy
+
+from yargy.tokenizer import MorphTokenizer
+
+# общий токенизатор для всех парсеров, чтобы морфологический анализ
+# фразы выполнялся один раз
+TOKENIZER = MorphTokenizer()
+
+
+class SkipTypes:
+    """Токенизатор base без токенов типов types, например, natasha
+    отбрасывает переводы строк. Токены фразы для него берутся из уже
+    готовых токенов base без повторного морфологического анализа."""
+
+    def __init__(self, base, types):
+        self.base = base
+        self.types = frozenset(types)
+
+    def __call__(self, text):
+        return (
+            token for token in self.base(text)
+            if token.type not in self.types
+        )
+
+
+@functools.lru_cache(maxsize=None)
+def skip_types(types):
+    """Общий для всех парсеров токенизатор TOKENIZER без типов types, чтобы
+    токены фразы для него вычислялись один раз."""
+
+    return SkipTypes(TOKENIZER, types)
+
+
+def shift_token(token, d):
+    token = copy(token)
+    token.span = type(token.span)(token.span[0] + d, token.span[1] + d)
+    return token
+
+
+class Phrase:
+    """Фраза пользователя вместе с ее токенами.
+
+    Токены хранятся для каждого токенизатора отдельно и вычисляются при
+    первом обращении. При замене сущности на метку заново анализируется
+    только затронутый участок, остальные токены сдвигаются.
+
+    Замены не перестраивают строку, а записываются в список участков, из
+    которого текст с метками собирается при обращении к text. По этому же
+    списку любой участок текста с метками переводится в участок исходного
+    текста."""
+
+    def __init__(self, text):
+        self.origin = text
+        # текст с метками: участки исходного текста (None, начало, конец)
+        # и метки (метка, начало, конец), где указан участок исходного
+        # текста, замененный меткой
+        self._pieces = [(None, 0, len(text))] if text else []
+        self._text = text
+        # замены (метка, начало, конец) в координатах исходного текста
+        self.edits = []
+        # id токенизатора -> (токенизатор, токены)
+        self._tokens = {}
+        # находки общего разбора по типам: списки пар из факта и участка
+        # в координатах текущего текста
+        self.found = {}
+        # организация, среди сотрудников которой ищутся имена
+        self.org = None
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return f'Phrase({self.text!r})'
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = ''.join(
+                self.origin[start:stop] if holder is None else holder
+                for holder, start, stop in self._pieces
+            )
+
+        return self._text
+
+    @property
+    def replaced(self):
+        """Сколько участков заменено."""
+
+        return len(self.edits)
+
+    def copy(self):
+        """Независимая копия. Списки токенов не изменяются на месте,
+        поэтому разделяются с оригиналом."""
+
+        phrase = Phrase(self.origin)
+        phrase._pieces = list(self._pieces)
+        phrase._text = self._text
+        phrase.edits = list(self.edits)
+        phrase._tokens = dict(self._tokens)
+        phrase.found = {k: list(v) for k, v in self.found.items()}
+        phrase.org = self.org
+        return phrase
+
+    def origin_spans(self, holder):
+        """Участки исходного текста, замененные меткой holder."""
+
+        return [(start, stop) for h, start, stop in self.edits if h == holder]
+
+    def to_origin(self, span):
+        """Перевести участок текста с метками в участок исходного текста.
+        Метка переводится в весь замененный ею участок."""
+
+        start = stop = None
+        pos = 0
+
+        for holder, a, b in self._pieces:
+            end = pos + (b - a if holder is None else len(holder))
+
+            if start is None and pos <= span[0] < end:
+                start = a + (span[0] - pos) if holder is None else a
+            if start is not None and pos < span[1] <= end:
+                stop = a + (span[1] - pos) if holder is None else b
+                break
+
+            pos = end
+
+        if start is None:
+            start = stop = len(self.origin)
+        elif stop is None:
+            stop = len(self.origin)
+
+        return start, stop
+
+    def tokenize(self, tokenizer=TOKENIZER):
+        key = id(tokenizer)
+        if key not in self._tokens:
+            if isinstance(tokenizer, SkipTypes):
+                tokens = [
+                    token for token in self.tokenize(tokenizer.base)
+                    if token.type not in tokenizer.types
+                ]
+            else:
+                tokens = list(tokenizer(self.text))
+
+            self._tokens[key] = (tokenizer, tokens)
+
+        return self._tokens[key][1]
+
+    def bind(self, tokenizer):
+        """Токенизатор для парсера, который отдает готовые токены фразы."""
+
+        def tokenize(text):
+            # экстрактор мог нормализовать текст перед разбором
+            if text == self.text:
+                return iter(self.tokenize(tokenizer))
+
+            return tokenizer(text)
+
+        return tokenize
+
+    def replace(self, spans, holder):
+        """Заменить участки фразы на метку сущности. Участки должны идти
+        по порядку и не пересекаться."""
+
+        d = 0
+        for span in spans:
+            start, stop = span[0] - d, span[1] - d
+            self.edits.append((holder, *self._splice(start, stop, holder)))
+            self._text = None
+
+            for key, (tokenizer, tokens) in self._tokens.items():
+                self._tokens[key] = (
+                    tokenizer,
+                    self._retokenize(tokenizer, tokens, start, stop, holder)
+                )
+
+            for kind, found in self.found.items():
+                self.found[kind] = self._shift_found(
+                    found, start, stop, holder)
+
+            d += (stop - start) - len(holder)
+
+        return self
+
+    def _splice(self, start, stop, holder):
+        # заменить участок текста с метками и вернуть соответствующий ему
+        # участок исходного текста
+        pieces = []
+        ostart = ostop = None
+        pos = 0
+
+        for piece in self._pieces:
+            h, a, b = piece
+            end = pos + (b - a if h is None else len(h))
+
+            if end <= start or pos >= stop:
+                pieces.append(piece)
+                pos = end
+                continue
+
+            # части затронутого участка до и после замены сохраняются,
+            # метка при этом становится обычным текстом
+            if ostart is None:
+                ostart = a + (start - pos) if h is None else a
+                if pos < start:
+                    keep = start - pos
+                    pieces.append(
+                        (None, a, a + keep) if h is None
+                        else (h[:keep], a, b)
+                    )
+
+            if end >= stop:
+                ostop = a + (stop - pos) if h is None else b
+
+                if holder:
+                    pieces.append((holder, ostart, ostop))
+
+                if end > stop:
+                    skip = stop - pos
+                    pieces.append(
+                        (None, a + skip, b) if h is None
+                        else (h[skip:], a, b)
+                    )
+
+            pos = end
+
+        self._pieces = pieces
+
+        return ostart, ostop
+
+    def _slice(self, start, stop):
+        # часть текста с метками без сборки всего текста
+        if self._text is not None:
+            return self._text[start:stop]
+
+        parts = []
+        pos = 0
+
+        for holder, a, b in self._pieces:
+            text = self.origin[a:b] if holder is None else holder
+            end = pos + len(text)
+
+            if end > start and pos < stop:
+                parts.append(text[max(0, start - pos):stop - pos])
+            if end >= stop:
+                break
+
+            pos = end
+
+        return ''.join(parts)
+
+    def _shift_found(self, found, start, stop, holder):
+        # находки внутри замененного участка пропадают
+        delta = len(holder) - (stop - start)
+        shifted = []
+
+        for fact, span in found:
+            if span[1] <= start:
+                shifted.append((fact, span))
+            elif span[0] >= stop:
+                shifted.append((fact, (span[0] + delta, span[1] + delta)))
+
+        return shifted
+
+    def _retokenize(self, tokenizer, tokens, start, stop, holder):
+        delta = len(holder) - (stop - start)
+
+        # затронутые токены, включая примыкающие без пробела к участку
+        i = 0
+        while i < len(tokens) and tokens[i].span[1] < start:
+            i += 1
+        j = i
+        while j < len(tokens) and tokens[j].span[0] <= stop:
+            j += 1
+
+        left, right = start, stop
+        if i < j:
+            left = min(left, tokens[i].span[0])
+            right = max(right, tokens[j - 1].span[1])
+
+        new = [
+            shift_token(token, left)
+            for token in tokenizer(self._slice(left, right + delta))
+        ]
+
+        return (
+            tokens[:i]
+            + new
+            + [shift_token(token, delta) for token in tokens[j:]]
+        )
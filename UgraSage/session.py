@@ -0,0 +1,353 @@
+"""Модуль с кэшем состояния диалога пользователей.
+
+Уточнение и временные данные пользователя хранятся в памяти процесса, а
+изменения временных данных записываются в базу фоновым потоком: несколько
+реплик одного пользователя между сбросами дают одну запись. Кэш корректен,
+только если все реплики пользователя обрабатывает один процесс, поэтому по
+умолчанию он выключен: его включают процессы dispatcher через enable, а
+единственный процесс -- через UGRASAGE_SESSION_CACHE=1."""
+
+import os
+import time
+import atexit
+import logging
+from copy import deepcopy
+from collections import OrderedDict
+from threading import Lock, Thread, Event
+
+import dbadapter
+
+MAXSIZE = int(os.environ.get('UGRASAGE_SESSIONS', 10000))
+# сколько секунд хранится состояние пользователя без обращений
+IDLE = float(os.environ.get('UGRASAGE_SESSION_IDLE', 600))
+# как часто изменения записываются в базу
+FLUSH_INTERVAL = float(os.environ.get('UGRASAGE_SESSION_FLUSH', 1))
+
+_logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class _Session:
+    __slots__ = ('known', 'clar', 'tmpdata', 'dirty', 'access', 'write_lock')
+
+    def __init__(self):
+        self.known = False
+        self.clar = _MISSING
+        self.tmpdata = _MISSING
+        self.dirty = False
+        self.access = 0.
+        # запись в базу и сброс временных данных пользователя не должны
+        # пересекаться, иначе сброс может быть перезаписан старыми данными
+        self.write_lock = Lock()
+
+
+def _copy_entity(entity):
+    # значения полей -- строки, числа или словари частей имени
+    return {
+        field: value.copy() if isinstance(value, (dict, list)) else value
+        for field, value in entity.items()
+    }
+
+
+def _copy_tmpdata(tmpdata):
+    """Копия временных данных для обработки реплики.
+
+    Обработчик изменяет на месте только ответ, а контекст и непроверенные
+    сущности заменяет новыми. Но сущности контекста переходят в сущности
+    фразы и могут измениться в них, поэтому копируются на два уровня."""
+
+    context = tmpdata['context']
+    entities = context['entities']
+
+    return {
+        **tmpdata,
+        'answer': deepcopy(tmpdata['answer']),
+        'context': {
+            **context,
+            'entities': type(entities)({
+                ent_name: _copy_entity(entity)
+                for ent_name, entity in dict.items(entities)
+            })
+        },
+        'unchecked_ents': [list(names) for names in tmpdata['unchecked_ents']]
+    }
+
+
+class SessionCache:
+    """Ограниченный кэш состояния пользователей с отложенной записью.
+
+    Записи, к которым давно не обращались, вытесняются, но только после
+    записи их изменений в базу."""
+
+    def __init__(self, db=dbadapter, maxsize=MAXSIZE, idle=IDLE,
+                 timer=time.monotonic):
+        self.db = db
+        self.maxsize = maxsize
+        self.idle = idle
+        self.timer = timer
+
+        self._sessions = OrderedDict()
+        self._lock = Lock()
+
+        self._stop = Event()
+        self._thread = None
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.flushes = 0
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _get(self, usr_id):
+        now = self.timer()
+
+        with self._lock:
+            session = self._sessions.get(usr_id)
+            if session is None:
+                session = self._sessions[usr_id] = _Session()
+            else:
+                self._sessions.move_to_end(usr_id)
+
+            session.access = now
+            self._evict(now)
+
+            return session
+
+    def _evict(self, now):
+        # вытесняются только записанные в базу записи, остальные дождутся
+        # следующей записи; обход идет от самых старых и заканчивается на
+        # первой свежей записи, если размер уже в пределах
+        size = len(self._sessions)
+        evicted = []
+
+        for usr_id, session in self._sessions.items():
+            if size <= self.maxsize and now - session.access < self.idle:
+                break
+
+            if not session.dirty:
+                evicted.append(usr_id)
+                size -= 1
+
+        for usr_id in evicted:
+            del self._sessions[usr_id]
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def check_user(self, usr_id):
+        session = self._get(usr_id)
+        if session.known:
+            return
+
+        self.db.check_user(usr_id)
+        session.known = True
+
+    def get_clar(self, usr_id):
+        session = self._get(usr_id)
+        clar = session.clar
+
+        self._count(clar is not _MISSING)
+        if clar is _MISSING:
+            clar = session.clar = self.db.get_clar(usr_id)
+
+        return clar
+
+    def invalidate_clar(self, usr_id):
+        """Забыть уточнение, например, после его изменения обработчиком."""
+
+        with self._lock:
+            session = self._sessions.get(usr_id)
+            if session is not None:
+                session.clar = _MISSING
+
+    def get_tmpdata(self, usr_id):
+        session = self._get(usr_id)
+        tmpdata = session.tmpdata
+
+        self._count(tmpdata is not _MISSING)
+        if tmpdata is _MISSING:
+            tmpdata = session.tmpdata = self.db.get_tmpdata(usr_id)
+
+        # вызывающий код изменяет временные данные, а поток записи может в
+        # это время сохранять хранящиеся в кэше
+        return _copy_tmpdata(tmpdata)
+
+    def peek_tmpdata(self, usr_id):
+        """Временные данные в кэше без копирования и обращения к базе."""
+
+        with self._lock:
+            session = self._sessions.get(usr_id)
+            if session is None or session.tmpdata is _MISSING:
+                return None
+            return session.tmpdata
+
+    def set_tmpdata(self, usr_id, tmpdata):
+        session = self._get(usr_id)
+
+        with self._lock:
+            session.tmpdata = tmpdata
+            session.dirty = True
+            self.writes += 1
+
+        self.start()
+
+    def reset_tmpdata(self, usr_id):
+        session = self._get(usr_id)
+
+        # ждет только записи данных этого пользователя
+        with session.write_lock:
+            with self._lock:
+                # несохраненные изменения больше не нужны
+                session.tmpdata = _MISSING
+                session.dirty = False
+
+            self.db.reset_tmpdata(usr_id)
+
+    def users(self):
+        with self._lock:
+            return list(self._sessions)
+
+    def invalidate(self, usr_id=None):
+        """Забыть состояние пользователя, а без usr_id -- всех, после
+        записи изменений в базу."""
+
+        self.flush()
+
+        with self._lock:
+            if usr_id is None:
+                self._sessions.clear()
+            else:
+                self._sessions.pop(usr_id, None)
+
+    def flush(self):
+        """Записать в базу все измененные временные данные."""
+
+        with self._lock:
+            dirty = [
+                (usr_id, session)
+                for usr_id, session in self._sessions.items()
+                if session.dirty
+            ]
+
+        for usr_id, session in dirty:
+            with session.write_lock:
+                # данные могли сбросить или уже записать
+                with self._lock:
+                    if not session.dirty:
+                        continue
+                    tmpdata = session.tmpdata
+
+                try:
+                    self.db.set_tmpdata(usr_id, tmpdata)
+                except Exception:
+                    _logger.warning(
+                        'Не удалось сохранить данные %s', usr_id,
+                        exc_info=True)
+                    continue
+
+                with self._lock:
+                    self.flushes += 1
+                    # данные могли измениться во время записи
+                    if session.tmpdata is tmpdata:
+                        session.dirty = False
+
+    def start(self, interval=FLUSH_INTERVAL):
+        if self._thread is not None:
+            return
+
+        with self._lock:
+            if self._thread is not None:
+                return
+
+            self._stop.clear()
+            self._thread = Thread(
+                target=self._run, args=(interval,), daemon=True)
+            self._thread.start()
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            self.flush()
+
+    def close(self):
+        """Остановить поток записи и сохранить оставшиеся изменения."""
+
+        thread = self._thread
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+            self._thread = None
+
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._sessions),
+                'maxsize': self.maxsize,
+                'dirty': sum(s.dirty for s in self._sessions.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'writes': self.writes,
+                'flushes': self.flushes
+            }
+
+
+sessions = None
+
+
+def enable():
+    """Включить кэш, если он еще не включен."""
+
+    global sessions
+
+    if sessions is None:
+        sessions = SessionCache()
+        atexit.register(sessions.close)
+
+    return sessions
+
+
+if os.environ.get('UGRASAGE_SESSION_CACHE', '0') == '1':
+    enable()
+
+
+def check_user(usr_id):
+    if sessions is None:
+        return dbadapter.check_user(usr_id)
+    return sessions.check_user(usr_id)
+
+
+def get_clar(usr_id):
+    if sessions is None:
+        return dbadapter.get_clar(usr_id)
+    return sessions.get_clar(usr_id)
+
+
+def invalidate_clar(usr_id):
+    if sessions is not None:
+        sessions.invalidate_clar(usr_id)
+
+
+def get_tmpdata(usr_id):
+    if sessions is None:
+        return dbadapter.get_tmpdata(usr_id)
+    return sessions.get_tmpdata(usr_id)
+
+
+def set_tmpdata(usr_id, tmpdata):
+    if sessions is None:
+        return dbadapter.set_tmpdata(usr_id, tmpdata)
+    return sessions.set_tmpdata(usr_id, tmpdata)
+
+
+def reset_tmpdata(usr_id):
+    if sessions is None:
+        return dbadapter.reset_tmpdata(usr_id)
+    return sessions.reset_tmpdata(usr_id)
@@ -0,0 +1,71 @@
+"""Модуль с ограниченным кэшем, записи которого устаревают со временем."""
+
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class TTLCache:
+    """Кэш с вытеснением давно не использованных записей и по времени жизни.
+
+    Значения хранятся как есть, копировать их при необходимости должен
+    вызывающий код."""
+
+    def __init__(self, maxsize=1024, ttl=600., timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+
+        # ключ -> (момент устаревания, значение)
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        now = self.timer()
+
+        with self._lock:
+            item = self._data.get(key)
+
+            if item is None or item[0] <= now:
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value, ttl=None):
+        expires = self.timer() + (self.ttl if ttl is None else ttl)
+
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """Удалить запись, а без ключа -- все записи."""
+
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses
+            }
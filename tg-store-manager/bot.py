@@ -11,9 +11,10 @@ import logging
 import json
 import collections
 from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
 
 from telebot import TeleBot
-from telebot.types import CallbackQuery, User, InputMediaPhoto
+from telebot.types import CallbackQuery, User, InputMediaPhoto, Message
 from telebot.apihelper import ApiTelegramException
 from telebot.custom_filters import TextMatchFilter
 from telebot.handler_backends import RedisHandlerBackend
@@ -43,6 +44,9 @@ from subscr import Subscription
 import tools
 import message as mestools
 import config as cfg
+import broadcast
+import checkpoints
+import recips
 
 BotSettings = tuple[
     TeleBot, str, bool, bool, bool, bool, int, str, bool, bool, bool
@@ -51,6 +55,11 @@ BotSettings = tuple[
 _LOGGER: Final = logging.getLogger('sstgb')
 _MX_CFG_SCR_DN: Final = gql(ConfigScr.Meta.document)
 
+# Сколько ботов одновременно делают рассылку
+_MAX_BROADCAST_WORKERS: Final = 8
+# Через сколько получателей записывать в журнал ход рассылки
+_REPORT_EVERY: Final = 100
+
 
 def _get_query_pref_filter(prefix: str) -> Callable[[CallbackQuery], bool]:
     return lambda query: query.data.startswith('!' + prefix)
@@ -218,24 +227,76 @@ def _apply_bots_settings(update: JsonDict) -> bool:
     return True
 
 
-def _send_org_notif(notif: dict, usr_ids: set[str], usr_ctx: UsrCtx) -> int:
+def _get_notif_images(notif: dict,
+                      token: str) -> tuple[list[InputMediaPhoto], bool]:
+    """Получить картинки уведомления и признак того, что все они уже
+    загружены ботом.
+    """
+    paths = [image['path'] for image in notif['images']]
+    file_ids = broadcast.get_file_ids(token, paths)
+
     images = [
         InputMediaPhoto(
-            f'https://{cfg.VITE_MX_STO_PATH}/{image["path"]}',
+            file_id or f'https://{cfg.VITE_MX_STO_PATH}/{path}',
             notif['text'] if i == 0 else None
-        ) for i, image in enumerate(notif['images'])
+        ) for i, (path, file_id) in enumerate(zip(paths, file_ids))
     ]
 
-    recip_count = 0
+    return images, all(file_ids)
+
+
+def _send_org_notif(notif: dict,
+                    recips_ctx: UsrCtx,
+                    usr_ctx: UsrCtx) -> int:
+    token = usr_ctx.tg_api.token
+    paths = [image['path'] for image in notif['images']]
+    images, uploaded = _get_notif_images(notif, token)
+
+    # Продолжить рассылку, прерванную перезапуском
+    checkpoint = checkpoints.store.get(notif['id'])
+    recip_count = checkpoint.recip_count if checkpoint else 0
+    proc_count = 0
+    # Темп отправки задают ограничения Telegram, см. broadcast
+    broadcaster = broadcast.get_broadcaster(token)
+
+    def send_images(usr_id: str,
+                    images: list[InputMediaPhoto]) -> list[Message]:
+        # Каждая картинка в группе считается отдельным сообщением
+        return broadcaster.send(
+            usr_id,
+            lambda: usr_ctx.tg_api.send_media_group(usr_id, images),
+            len(images)
+        )
+
+    after = checkpoint.last_usr_id if checkpoint else None
 
-    for usr_id in usr_ids:
+    # Получатели идут по возрастанию ИД, а отправка начинается после
+    # загрузки первой страницы
+    for usr_id in recips.iter_recips(recips_ctx, after):
         usr_ctx.__dict__['usr_id'] = usr_id
 
         try:
             if images:  # уведомление с картинками
-                usr_ctx.tg_api.send_media_group(usr_id, images)
+                try:
+                    msgs = send_images(usr_id, images)
+                except ApiTelegramException as err:
+                    # Сохраненный file_id мог стать недействительным
+                    if not uploaded or not broadcast.is_file_id_error(err):
+                        raise
+
+                    broadcast.forget_file_ids(token, paths)
+                    images, uploaded = _get_notif_images(notif, token)
+                    msgs = send_images(usr_id, images)
+
+                # Следующим пользователям картинки отправляются по file_id
+                if not uploaded:
+                    broadcast.save_file_ids(token, paths, msgs)
+                    images, uploaded = _get_notif_images(notif, token)
             else:
-                mestools.send_mes(notif['text'], usr_ctx=usr_ctx)
+                broadcaster.send(
+                    usr_id,
+                    lambda: mestools.send_mes(notif['text'], usr_ctx=usr_ctx)
+                )
         except ApiTelegramException as err:
             if err.error_code == 403:  # бот остановлен
                 mxusr.update_bot_status(True, usr_ctx)
@@ -246,9 +307,71 @@ def _send_org_notif(notif: dict, usr_ids: set[str], usr_ctx: UsrCtx) -> int:
         else:
             recip_count += 1
 
+        proc_count += 1
+
+        # Ход сохраняется после каждого получателя: запись в Redis дешевле
+        # повторного уведомления после перезапуска. Повторный запуск
+        # продолжит со следующего получателя, а после завершения рассылки
+        # ничего не отправит до deliver_notifs
+        checkpoints.store.save(
+            notif['id'], checkpoints.Checkpoint(usr_id, recip_count))
+
+        if proc_count % _REPORT_EVERY == 0:
+            _LOGGER.info(
+                f'Уведомление {notif["id"]}: доставлено {recip_count}')
+
     return recip_count
 
 
+def _proc_org_notifs(org_id: str,
+                     notifs: list[dict],
+                     bot_settings: BotSettings) -> bool:
+    _LOGGER.info(
+        (f'Начало рассылки уведомлений ({len(notifs)}) для организации '
+         f'{org_id}')
+    )
+
+    notif_ids = []
+    usr_ctx = UsrCtx(org_id=org_id)
+    usr_ctx.__dict__['tg_api'] = bot_settings[0]
+    # В usr_ctx при отправке подставляется получатель, а получатели
+    # загружаются от имени организации
+    recips_ctx = UsrCtx(org_id=org_id)
+
+    recip_count = 0
+
+    for notif in notifs:
+        notif_ids.append(notif['id'])
+
+        try:
+            recip_count = _send_org_notif(notif, recips_ctx, usr_ctx)
+        except recips.RecipsLoadError:
+            _LOGGER.exception(
+                f'Не удалось загрузить получателей уведомления {notif["id"]}')
+            return False
+
+    # NOTE Намеренно берем количество получателей последнего
+    # уведомления в пакете
+    mxbot.deliver_notifs(notif_ids, recip_count, usr_ctx)
+
+    for notif_id in notif_ids:
+        checkpoints.store.delete(notif_id)
+
+    return True
+
+
+def _proc_bot_notifs(
+    orgs_notifs: list[tuple[str, list[dict], BotSettings]]
+) -> None:
+    # Организации одного бота обслуживаются по очереди, так как
+    # ограничения Telegram общие для бота
+    for org_id, notifs, bot_settings in orgs_notifs:
+        if not _proc_org_notifs(org_id, notifs, bot_settings):
+            _LOGGER.error(
+                f'Не удалось получить получателей организации {org_id}')
+            return
+
+
 def _proc_mx_notifs(update: JsonDict) -> bool:
     # NOTE Несколько сервисов не должны обслуживать одну организацию
     if not storage.take_control():
@@ -264,53 +387,31 @@ def _proc_mx_notifs(update: JsonDict) -> bool:
 
     MX_NOTIFS_LOCK.wait_for(lambda: bool(BOTS_SETTINGS))
 
-    for org_id, notifs in notifs_map.items():
-        _LOGGER.info(
-            (f'Начало рассылки уведомлений ({len(notifs)}) для организации '
-             f'{org_id}')
-        )
-
-        notif_ids = []
-        usr_ctx = UsrCtx(org_id=org_id)
-
-        # NOTE Брать ИД не из локальной базы, а из Хасуры. После
-        # обновления бота состояние может быть очищено.
+    # Рассылки разных ботов идут параллельно
+    bots_notifs = collections.defaultdict(list)
 
-        # Брать также из User, чтобы зацепить активных пользователей до
-        # появления BotUser
-
-        responses = [
-            mxusr.get_bot_users(usr_ctx=usr_ctx),
-            mxusr.get_usrs_tg(usr_ctx=usr_ctx)
-        ]
-
-        if any([response is None for response in responses]):
-            return False
-
-        usr_ids = {
-            item['tgUsrId'] for response in responses
-            for item in response  # type: ignore[union-attr]
-        }
-
-        if bot_settings := ORGS_BOT_SETTINGS.get(org_id):
-            usr_ctx.__dict__['tg_api'] = bot_settings[0]
-        else:
+    for org_id, notifs in notifs_map.items():
+        if not (bot_settings := ORGS_BOT_SETTINGS.get(org_id)):
             _LOGGER.warning(
                 f'Рассылка пропущена: организация {org_id} не обслуживается'
             )
             continue
 
-        recip_count = 0
+        bots_notifs[bot_settings[0].token].append(
+            (org_id, notifs, bot_settings))
 
-        for notif in notifs:
-            notif_ids.append(notif['id'])
-
-            if bot_settings:
-                recip_count = _send_org_notif(notif, usr_ids, usr_ctx)
+    with ThreadPoolExecutor(
+        min(_MAX_BROADCAST_WORKERS, len(bots_notifs)) or 1,
+        thread_name_prefix='broadcast'
+    ) as executor:
+        futures = [
+            executor.submit(_proc_bot_notifs, orgs_notifs)
+            for orgs_notifs in bots_notifs.values()
+        ]
 
-        # NOTE Намеренно берем количество получателей последнего
-        # уведомления в пакете
-        mxbot.deliver_notifs(notif_ids, recip_count, usr_ctx)
+    for future in futures:
+        if exc := future.exception():
+            _LOGGER.error('Рассылка прервана', exc_info=exc)
 
     return False
 
@@ -0,0 +1,229 @@
+"""Массовая рассылка с соблюдением ограничений Telegram.
+
+Не чаще 30 сообщений в секунду от бота и 1 сообщения в секунду в чат:
+https://core.telegram.org/bots/faq#broadcasting-to-users
+
+Сообщения не отправляются быстрее, чем пополняются корзины токенов бота и
+чата, а при ответе 429 бот ждет столько, сколько указал Telegram.
+"""
+
+from typing import Final, Callable, TypeVar
+from threading import Lock
+from collections import OrderedDict
+import time
+import logging
+
+from telebot.types import Message
+from telebot.apihelper import ApiTelegramException
+
+T = TypeVar('T')
+
+_LOGGER: Final = logging.getLogger('sstgb')
+
+BOT_RATE: Final = 30.
+CHAT_RATE: Final = 1.
+
+MAX_RETRIES: Final = 5
+# Начальная задержка повтора в секундах, удваивается с каждой попыткой
+BACKOFF: Final = 1.
+MAX_BACKOFF: Final = 60.
+
+# Сколько корзин чатов хранить до удаления полных
+_MAX_CHATS: Final = 10000
+_MAX_FILE_IDS: Final = 4096
+
+
+class TokenBucket:
+    """Корзина токенов, которая может уходить в долг.
+
+    Каждая отправка сразу резервирует токены и получает время, которое нужно
+    подождать, поэтому потоки не ждут друг друга под блокировкой.
+    """
+
+    def __init__(self,
+                 rate: float,
+                 capacity: float | None = None,
+                 timer: Callable[[], float] = time.monotonic) -> None:
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._timer = timer
+
+        self._tokens = self.capacity
+        self._stamp = timer()
+        self._lock = Lock()
+
+    def _refill(self) -> None:
+        now = self._timer()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def reserve(self, cost: float = 1.) -> float:
+        """Взять токены и вернуть, сколько секунд подождать до отправки.
+
+        Больше capacity токенов за раз не берется, иначе отправка ждала бы
+        дольше, чем нужно для пополнения полной корзины.
+        """
+        with self._lock:
+            self._refill()
+            self._tokens -= min(cost, self.capacity)
+
+            return max(0., -self._tokens / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        """Не выдавать токены ближайшие seconds секунд."""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, -seconds * self.rate)
+
+    def is_full(self) -> bool:
+        with self._lock:
+            self._refill()
+            return self._tokens >= self.capacity
+
+
+def _get_retry_after(err: ApiTelegramException) -> float | None:
+    params = (err.result_json or {}).get('parameters') or {}
+    return params.get('retry_after')
+
+
+# Подстроки описания ошибки 400 при недействительном file_id, например,
+# «Bad Request: wrong file identifier/HTTP URL specified». Остальные
+# ошибки 400, например, «chat not found», к картинкам не относятся.
+_FILE_ID_ERRORS: Final = (
+    'wrong file identifier',
+    'wrong remote file identifier',
+    'file_reference',
+    'file_id'
+)
+
+
+def is_file_id_error(err: ApiTelegramException) -> bool:
+    if err.error_code != 400:
+        return False
+
+    description = ((err.result_json or {}).get('description') or '').lower()
+    return any(_ in description for _ in _FILE_ID_ERRORS)
+
+
+class Broadcaster:
+    """Отправка сообщений от одного бота."""
+
+    def __init__(self, token: str) -> None:
+        self.token = token
+        self.bucket = TokenBucket(BOT_RATE)
+
+        self._chats: dict[str | int, TokenBucket] = {}
+        self._lock = Lock()
+
+        self.sent = 0
+        self.retries = 0
+
+    def _chat_bucket(self, chat_id: str | int) -> TokenBucket:
+        with self._lock:
+            if (bucket := self._chats.get(chat_id)) is None:
+                if len(self._chats) >= _MAX_CHATS:
+                    # Полные корзины ничем не отличаются от новых
+                    for key in [k for k, v in self._chats.items()
+                                if v.is_full()]:
+                        del self._chats[key]
+
+                bucket = self._chats[chat_id] = TokenBucket(CHAT_RATE)
+
+            return bucket
+
+    def send(self,
+             chat_id: str | int,
+             send: Callable[[], T],
+             cost: int = 1) -> T:
+        """Вызвать send, когда это разрешают ограничения.
+
+        cost -- число сообщений, например, картинок в группе. Оно учитывается
+        только в корзине бота: для чата группа -- одна отправка. Ошибки,
+        кроме 429 и ошибок сервера, передаются вызывающему коду.
+        """
+        chat = self._chat_bucket(chat_id)
+        backoff = BACKOFF
+        attempt = 0
+
+        while True:
+            delay = max(chat.reserve(), self.bucket.reserve(cost))
+            if delay:
+                time.sleep(delay)
+
+            try:
+                res = send()
+            except ApiTelegramException as err:
+                if attempt == MAX_RETRIES or not (
+                        err.error_code == 429 or err.error_code >= 500):
+                    raise
+
+                attempt += 1
+                self.retries += 1
+
+                if (retry_after := _get_retry_after(err)) is not None:
+                    # Ограничение превышено для всего бота
+                    _LOGGER.warning(
+                        f'Рассылка приостановлена на {retry_after} с')
+                    self.bucket.pause(retry_after)
+                else:
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, MAX_BACKOFF)
+            else:
+                self.sent += 1
+                return res
+
+
+_BROADCASTERS: Final[dict[str, Broadcaster]] = {}
+_BROADCASTERS_LOCK: Final = Lock()
+
+
+def get_broadcaster(token: str) -> Broadcaster:
+    """Общий для всех рассылок бота объект, чтобы ограничения учитывались
+    между рассылками.
+    """
+    with _BROADCASTERS_LOCK:
+        if (broadcaster := _BROADCASTERS.get(token)) is None:
+            broadcaster = _BROADCASTERS[token] = Broadcaster(token)
+
+        return broadcaster
+
+
+# Картинки загружаются в Telegram один раз для каждого бота, а затем
+# отправляются по file_id
+# (токен бота, путь картинки) -> file_id
+_FILE_IDS: Final[OrderedDict[tuple[str, str], str]] = OrderedDict()
+_FILE_IDS_LOCK: Final = Lock()
+
+
+def get_file_ids(token: str, paths: list[str]) -> list[str | None]:
+    with _FILE_IDS_LOCK:
+        file_ids = []
+
+        for path in paths:
+            if (file_id := _FILE_IDS.get((token, path))) is not None:
+                _FILE_IDS.move_to_end((token, path))
+            file_ids.append(file_id)
+
+        return file_ids
+
+
+def save_file_ids(token: str, paths: list[str], msgs: list[Message]) -> None:
+    """Запомнить file_id картинок из ответа на send_media_group."""
+    with _FILE_IDS_LOCK:
+        for path, msg in zip(paths, msgs):
+            if not msg.photo:
+                continue
+
+            # Самый большой размер -- загруженный оригинал
+            _FILE_IDS[(token, path)] = msg.photo[-1].file_id
+            _FILE_IDS.move_to_end((token, path))
+
+        while len(_FILE_IDS) > _MAX_FILE_IDS:
+            _FILE_IDS.popitem(last=False)
+
+
+def forget_file_ids(token: str, paths: list[str]) -> None:
+    with _FILE_IDS_LOCK:
+        for path in paths:
+            _FILE_IDS.pop((token, path), None)
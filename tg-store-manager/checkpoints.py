@@ -0,0 +1,97 @@
+"""Сохранение хода рассылки, чтобы продолжить ее после перезапуска.
+
+Получатели обходятся в порядке возрастания ИД, поэтому достаточно хранить
+ИД последнего обработанного получателя и число доставленных сообщений.
+"""
+
+from typing import Final, Protocol, NamedTuple
+from threading import Lock
+import json
+import logging
+
+import redis
+
+import config as cfg
+
+_LOGGER: Final = logging.getLogger('sstgb')
+
+# Сколько секунд хранится ход незавершенной рассылки
+_TTL: Final = 7 * 24 * 60 * 60
+
+
+class Checkpoint(NamedTuple):
+    last_usr_id: str
+    recip_count: int
+
+
+class CheckpointStore(Protocol):
+    def get(self, notif_id: str) -> Checkpoint | None:
+        ...
+
+    def save(self, notif_id: str, checkpoint: Checkpoint) -> None:
+        ...
+
+    def delete(self, notif_id: str) -> None:
+        ...
+
+
+class MemoryCheckpointStore:
+    """Хранилище в памяти процесса, например, для тестов."""
+
+    def __init__(self) -> None:
+        self._checkpoints: dict[str, Checkpoint] = {}
+        self._lock = Lock()
+
+    def get(self, notif_id: str) -> Checkpoint | None:
+        with self._lock:
+            return self._checkpoints.get(notif_id)
+
+    def save(self, notif_id: str, checkpoint: Checkpoint) -> None:
+        with self._lock:
+            self._checkpoints[notif_id] = checkpoint
+
+    def delete(self, notif_id: str) -> None:
+        with self._lock:
+            self._checkpoints.pop(notif_id, None)
+
+
+class RedisCheckpointStore:
+    """Хранилище в Redis, который уже используется для состояния ботов.
+
+    Недоступность Redis не должна останавливать рассылку, поэтому ошибки
+    только записываются в журнал.
+    """
+
+    def __init__(self, host: str, ttl: int = _TTL) -> None:
+        self._redis = redis.Redis(host=host)
+        self._ttl = ttl
+
+    @staticmethod
+    def _key(notif_id: str) -> str:
+        return f'sstgb:notif:{notif_id}'
+
+    def get(self, notif_id: str) -> Checkpoint | None:
+        try:
+            value = self._redis.get(self._key(notif_id))
+        except redis.RedisError:
+            _LOGGER.exception(f'Не удалось получить ход рассылки {notif_id}')
+            return None
+
+        return Checkpoint(*json.loads(value)) if value else None
+
+    def save(self, notif_id: str, checkpoint: Checkpoint) -> None:
+        try:
+            self._redis.set(
+                self._key(notif_id), json.dumps(checkpoint), ex=self._ttl)
+        except redis.RedisError:
+            _LOGGER.exception(f'Не удалось сохранить ход рассылки {notif_id}')
+
+    def delete(self, notif_id: str) -> None:
+        try:
+            self._redis.delete(self._key(notif_id))
+        except redis.RedisError:
+            _LOGGER.exception(f'Не удалось удалить ход рассылки {notif_id}')
+
+
+# Можно заменить на MemoryCheckpointStore
+store: CheckpointStore = RedisCheckpointStore(cfg.CACHE_HOST)
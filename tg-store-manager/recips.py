@@ -0,0 +1,94 @@
+"""Постраничная загрузка получателей рассылки.
+
+Получатели читаются из Хасуры страницами по возрастанию tgUsrId, и каждая
+следующая страница начинается после последнего ИД предыдущей. Поэтому
+отправка начинается после загрузки первой страницы, в памяти хранится по
+одной странице на источник, а продолжение рассылки после перезапуска не
+загружает уже обработанных получателей.
+"""
+
+from typing import Final, Iterator
+import heapq
+
+from gql import gql
+
+from metrix import metrix
+from usrctx import UsrCtx
+
+# Сколько получателей загружать за один запрос
+PAGE_SIZE: Final = 1000
+
+# NOTE Брать ИД не из локальной базы, а из Хасуры. После обновления бота
+# состояние может быть очищено. Брать также из User, чтобы зацепить
+# активных пользователей до появления BotUser
+
+_BOT_USERS_PAGE_DN: Final = gql('''
+    query BotUsersPage($orgId: uuid!, $after: String!, $limit: Int!) {
+        BotUser(
+            where: {orgId: {_eq: $orgId}, tgUsrId: {_gt: $after}},
+            order_by: {tgUsrId: asc},
+            limit: $limit
+        ) {
+            tgUsrId
+        }
+    }
+''')
+
+_USRS_TG_PAGE_DN: Final = gql('''
+    query UsersTgPage($orgId: uuid!, $after: String!, $limit: Int!) {
+        User(
+            where: {orgId: {_eq: $orgId}, tgUsrId: {_gt: $after}},
+            order_by: {tgUsrId: asc},
+            limit: $limit
+        ) {
+            tgUsrId
+        }
+    }
+''')
+
+
+class RecipsLoadError(Exception):
+    pass
+
+
+def _iter_source(document: object,
+                 table: str,
+                 usr_ctx: UsrCtx,
+                 after: str) -> Iterator[str]:
+    while True:
+        res = metrix.execute(
+            document,
+            {'orgId': usr_ctx.org_id, 'after': after, 'limit': PAGE_SIZE}
+        )
+
+        if res is None:
+            raise RecipsLoadError(table)
+
+        page = [item['tgUsrId'] for item in res[table]]
+
+        # Слияние и контрольные точки сравнивают ИД как строки Python,
+        # а порядок Хасуры задает правило сортировки базы
+        if any(a >= b for a, b in zip([after, *page], page)):
+            raise RecipsLoadError(f'{table}: ИД не по возрастанию')
+
+        yield from page
+
+        if len(page) < PAGE_SIZE:
+            return
+
+        after = page[-1]
+
+
+def iter_recips(usr_ctx: UsrCtx, after: str | None = None) -> Iterator[str]:
+    """ИД получателей организации после after по возрастанию без
+    повторов.
+    """
+    last = None
+
+    for usr_id in heapq.merge(
+        _iter_source(_BOT_USERS_PAGE_DN, 'BotUser', usr_ctx, after or ''),
+        _iter_source(_USRS_TG_PAGE_DN, 'User', usr_ctx, after or '')
+    ):
+        if usr_id != last:
+            yield usr_id
+            last = usr_id